@@ -1,20 +1,48 @@
+import numpy as np
 import pandas as pd
 import argparse
+import copy
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from scipy.optimize import minimize_scalar
 from sklearn import metrics
 import warnings
-import math
-import re
+from utils.wss import threshold_sweep, wss_at_recall
+
+INC_EXC_INSTRUCTION = 'should the study be included or excluded?'
+LABEL_MAPPING = {'Include': 'Included', 'Exclude': 'Excluded', 'Insufficient': 'Included', 'Excluded.': 'Excluded', 'Included.': 'Included', 'Excluded:': 'Excluded',
+                 'exclude': 'Excluded', 'included': 'Included', 'included.': 'Included', 'excluded': 'Excluded', 'included:': 'Included', 'excluded:': 'Excluded',
+                 'include': 'Included', 'exclude.': 'Excluded', 'excluded.': 'Excluded'}
 
 def warn(*args, **kwargs):
     pass
 
-def main(args):
-    warnings.warn = warn
+def hash_key(df):
+    # compact 64-bit join key, so results and gold are never merged on the multi-kilobyte text columns
+    return pd.util.hash_pandas_object(df[['instruction', 'input']].apply(lambda x: x.str.strip()), index=False).values
+
+def map_labels(labels):
+    return labels.map(LABEL_MAPPING).fillna(labels)
+
+def parse_predictions(responses, rogue_tokens):
+    responses = responses.str.strip()
+    if rogue_tokens:
+        predictions = responses.fillna("").str.lower().str.extract(r'(include|exclude)', expand=False).fillna("error")
+        return map_labels(predictions)
+    return responses.str.split().str[0]
+
+def read_results(args):
+    # yields the results file in chunks so only the join key and prediction of each row are kept in memory
+    if not args.lines:
+        yield pd.read_json(args.results_path)
+        return
 
     try:
-        results = pd.read_json(args.results_path, lines=args.lines)
-    except:
+        for chunk in pd.read_json(args.results_path, lines=True, chunksize=args.chunksize):
+            yield chunk
+    except ValueError:
         print(f'Error reading results file: {args.results_path}. Checking for errors in file...')
         with open(args.results_path, 'r') as f:
             for i, line in enumerate(f):
@@ -22,45 +50,186 @@ def main(args):
                     json.loads(line)
                 except:
                     raise ValueError(f'Error on line {i}')
-                
+
         raise ValueError(f'Error reading {args.results_path}')
 
-    label_mapping = {'Include': 'Included', 'Exclude': 'Excluded', 'Insufficient': 'Included', 'Excluded.': 'Excluded', 'Included.': 'Included', 'Excluded:': 'Excluded',
-                     'exclude': 'Excluded', 'included': 'Included', 'included.': 'Included', 'excluded': 'Excluded', 'included:': 'Included', 'excluded:': 'Excluded',
-                     'include': 'Included', 'exclude.': 'Excluded', 'excluded.': 'Excluded'}
+def load_predictions(args):
+    predictions = []
+    for chunk in read_results(args):
+        chunk = chunk[chunk['instruction'].str.contains(INC_EXC_INSTRUCTION)]
+        if len(chunk) == 0:
+            continue
+        chunk_predictions = pd.DataFrame({'key': hash_key(chunk), 'prediction': parse_predictions(chunk['response'], args.rogue_tokens).values})
+        if 'include_prob' in chunk.columns:
+            chunk_predictions['include_prob'] = chunk['include_prob'].values
+        predictions.append(chunk_predictions)
+
+    if not predictions:
+        return pd.DataFrame(columns=['key', 'prediction'])
+    return pd.concat(predictions, ignore_index=True)
+
+def load_gold(args):
     dataset_inc_exc = pd.read_json(args.dataset_path)
-    dataset_inc_exc[args.label_field_name] = dataset_inc_exc[args.label_field_name].str.split().str[0]
-    dataset_inc_exc[args.label_field_name] = dataset_inc_exc[args.label_field_name].transform(lambda x: label_mapping[x] if x in label_mapping else x)
-
-    inc_exc = results[results['instruction'].str.contains('should the study be included or excluded?')]
-    inc_exc = inc_exc.transform(lambda x: x.str.strip())
-    if args.rogue_tokens:
-        inc_exc['prediction'] = inc_exc['response'].fillna("").apply(lambda x: next(re.finditer(r'(include)|(exclude)', x.lower()), ["error"])[0])
-        inc_exc['prediction'] = inc_exc['prediction'].transform(lambda x: label_mapping[x] if x in label_mapping else x)
-    else:
-        inc_exc['prediction'] = inc_exc['response'].str.split().str[0]
+    labels = dataset_inc_exc[args.label_field_name].str.split().str[0]
+    gold = pd.DataFrame({'key': hash_key(dataset_inc_exc), args.label_field_name: map_labels(labels).values})
+    if 'doi' in dataset_inc_exc.columns:
+        gold['doi'] = dataset_inc_exc['doi'].values
+    return gold
+
+def merge_predictions(gold, predictions):
+    merged = gold.merge(predictions, on='key', how='left')
+    return merged.dropna(subset=['prediction'])
+
+def sweep_thresholds(merged, label_field_name, target_recall):
+    if 'include_prob' not in merged.columns:
+        raise ValueError('Threshold sweep needs results with an include_prob field (generate_cli.py --score_mode logits)')
+
+    groups = [('all', merged)]
+    if 'doi' in merged.columns:
+        groups += list(merged.groupby('doi'))
+
+    sweeps, summary = [], []
+    for doi, group in groups:
+        sweep = threshold_sweep((group[label_field_name] == 'Included').values, group['include_prob'].values.astype(float))
+        wss, threshold = wss_at_recall(sweep, target_recall)
+        sweeps.append(pd.DataFrame({'doi': doi, **sweep}))
+        summary.append({'doi': doi, 'n': len(group), 'included': int((group[label_field_name] == 'Included').sum()),
+                        f'wss@{round(target_recall * 100)}': wss, 'threshold': threshold})
+
+    return pd.concat(sweeps, ignore_index=True), pd.DataFrame(summary)
+
+def fit_temperature(included, include_probs, eps=1e-6):
+    """
+    Temperature minimising the negative log-likelihood of the gold labels under the include probabilities.
+    The include/exclude logit margin is recovered as log(p / (1 - p)), so the fitted value is relative to the
+    temperature the results were scored with: pass their product as generate_cli.py --score_temperature.
+    """
+    include_probs = np.clip(include_probs, eps, 1 - eps)
+    margins = np.log(include_probs) - np.log1p(-include_probs)
+    signs = np.where(included, 1.0, -1.0)
+
+    def nll(log_temperature):
+        # -log sigmoid(sign * margin / T), written to stay finite for large margins
+        return np.logaddexp(0, -signs * margins / np.exp(log_temperature)).mean()
+
+    result = minimize_scalar(nll, bounds=(-5, 5), method='bounded')
+    return float(np.exp(result.x)), float(nll(0.0)), float(result.fun)
+
+def calibrate(merged, label_field_name):
+    if 'include_prob' not in merged.columns:
+        raise ValueError('Temperature fitting needs results with an include_prob field (generate_cli.py --score_mode logits)')
+    temperature, nll_before, nll_after = fit_temperature((merged[label_field_name] == 'Included').values,
+                                                         merged['include_prob'].values.astype(float))
+    print(f'Fitted temperature {temperature:.4f} on {len(merged)} samples (NLL {nll_before:.4f} -> {nll_after:.4f}). '
+          f'Multiply the --score_temperature these results were scored with by it.')
+    return temperature
 
-    merged = pd.merge(dataset_inc_exc, inc_exc, on=['instruction', 'input'], how='left')
-    merged = merged.dropna(subset=['prediction'])
+def evaluate_predictions(gold, predictions, label_field_name):
+    merged = merge_predictions(gold, predictions)
 
     try:
-        class_report = metrics.classification_report(merged[args.label_field_name], merged['prediction'], digits=2, labels=['Included', 'Excluded'], output_dict=True)
-        conf_mat = metrics.confusion_matrix(merged[args.label_field_name], merged['prediction'], labels=['Included', 'Excluded'])
+        class_report = metrics.classification_report(merged[label_field_name], merged['prediction'], digits=2, labels=['Included', 'Excluded'], output_dict=True)
+        conf_mat = metrics.confusion_matrix(merged[label_field_name], merged['prediction'], labels=['Included', 'Excluded'])
     except:
-        class_report = metrics.classification_report(merged[args.label_field_name+'_x'], merged['prediction'], digits=2, output_dict=True)
-        conf_mat = metrics.confusion_matrix(merged[args.label_field_name+'_x'], merged['prediction'])
-    
-    # print(pd.DataFrame(class_report).T)
-    # print(conf_mat)
+        class_report = metrics.classification_report(merged[label_field_name], merged['prediction'], digits=2, output_dict=True)
+        conf_mat = metrics.confusion_matrix(merged[label_field_name], merged['prediction'])
 
     return pd.DataFrame(class_report).T, conf_mat
 
+def main(args):
+    warnings.warn = warn
+
+    gold = load_gold(args)
+    predictions = load_predictions(args)
+
+    if args.sweep_output is not None:
+        sweep, summary = sweep_thresholds(merge_predictions(gold, predictions), args.label_field_name, args.target_recall)
+        sweep.to_csv(args.sweep_output, index=False)
+        print(summary.to_string(index=False))
+
+    if args.fit_temperature:
+        calibrate(merge_predictions(gold, predictions), args.label_field_name)
+
+    return evaluate_predictions(gold, predictions, args.label_field_name)
+
+def summarise(class_report, merged, label_field_name):
+    # one row of the consolidated metrics table
+    row = {}
+    for label in ['Included', 'Excluded']:
+        for metric in ['precision', 'recall', 'f1-score']:
+            row[f'{label.lower()}_{metric}'] = class_report.loc[label, metric] if label in class_report.index else float('nan')
+    row['macro_f1'] = class_report.loc['macro avg', 'f1-score']
+    # from every evaluated row, the report and confusion matrix leave out predictions that aren't a label
+    row['accuracy'] = (merged[label_field_name] == merged['prediction']).mean()
+    row['n'] = len(merged)
+    return row
+
+def evaluate_results_file(gold, results_path, args):
+    warnings.warn = warn
+    args = copy.copy(args)
+    args.results_path = results_path
+    predictions = load_predictions(args)
+    class_report, _ = evaluate_predictions(gold, predictions, args.label_field_name)
+    return summarise(class_report, merge_predictions(gold, predictions), args.label_field_name)
+
+def parse_splits(args):
+    # NAME=PATH[,LABEL_FIELD_NAME]
+    splits = {}
+    for split in args.split:
+        name, spec = split.split('=', 1)
+        path, _, label_field_name = spec.partition(',')
+        splits[name] = (path, label_field_name or args.label_field_name)
+    return splits
+
+def batch_main(args):
+    warnings.warn = warn
+
+    jobs = []
+    for name, (dataset_path, label_field_name) in parse_splits(args).items():
+        split_args = copy.copy(args)
+        split_args.dataset_path, split_args.label_field_name = dataset_path, label_field_name
+        # the gold set is loaded once per split and shared by every results file evaluated against it
+        gold = load_gold(split_args)
+        for results_path in sorted(glob(args.results_glob.format(split=name))):
+            jobs.append((name, results_path, gold, split_args))
+
+    if not jobs:
+        raise ValueError(f'No results files found for {args.results_glob}')
+
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = [executor.submit(evaluate_results_file, gold, results_path, split_args) for _, results_path, gold, split_args in jobs]
+        rows = [{'split': name, 'results_path': results_path, **future.result()} for (name, results_path, _, _), future in zip(jobs, futures)]
+
+    table = pd.DataFrame(rows)
+    table.to_csv(args.metrics_output, index=False)
+    print(table.to_string(index=False))
+    print(f'Metrics for {len(rows)} results files written to {args.metrics_output}')
+    return table
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--results_path', type=str, required=True, help='Path to eval results')
-    parser.add_argument('--dataset_path', type=str, required=True, help='Path to eval dataset')
+    parser.add_argument('--results_path', type=str, default=None, help='Path to eval results')
+    parser.add_argument('--dataset_path', type=str, default=None, help='Path to eval dataset')
     parser.add_argument('--label_field_name', default='label', type=str, help='Name of label field in dataset')
     parser.add_argument('--lines', action='store_true', help='Whether results are stored as lines (jsonl)')
     parser.add_argument('--rogue_tokens', action='store_true', help='Whether the model has an unusual starting tokens')
+    parser.add_argument('--chunksize', type=int, default=100000, help='Number of result lines parsed at a time when --lines is set')
+    parser.add_argument('--sweep_output', type=str, default=None, help='Write recall, precision, workload saved and WSS at every include_prob threshold, per review and overall, to this csv')
+    parser.add_argument('--target_recall', type=float, default=0.95, help='Recall at which WSS is reported for the threshold sweep')
+    parser.add_argument('--fit_temperature', action='store_true', help='Fit the include/exclude score temperature to the gold labels by minimising NLL, for generate_cli.py --score_temperature')
+    parser.add_argument('--split', action='append', default=[], help='Batch mode: eval split as NAME=DATASET_PATH[,LABEL_FIELD_NAME], can be repeated')
+    parser.add_argument('--results_glob', type=str, default=None, help='Batch mode: glob of results files, with {split} replaced by each split name')
+    parser.add_argument('--metrics_output', type=str, default='metrics.csv', help='Batch mode: where to write the consolidated metrics table')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Batch mode: number of results files evaluated in parallel')
     args = parser.parse_args()
-    main(args)
+
+    if args.split:
+        if args.results_glob is None:
+            parser.error('--results_glob is required with --split')
+        batch_main(args)
+    else:
+        if args.results_path is None or args.dataset_path is None:
+            parser.error('--results_path and --dataset_path are required unless --split is given')
+        class_report, conf_mat = main(args)
+        print(class_report)
+        print(conf_mat)
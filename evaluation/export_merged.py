@@ -0,0 +1,58 @@
+import argparse
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftConfig, PeftModel
+from generate_cli import smart_tokenizer_and_embedding_resize, DEFAULT_BOS_TOKEN, DEFAULT_EOS_TOKEN, \
+    DEFAULT_UNK_TOKEN, DEFAULT_PAD_TOKEN
+
+
+def main(args):
+    print(args.lora_weights)
+    peft_config = PeftConfig.from_pretrained(args.lora_weights)
+    print("peft_config: ", peft_config)
+
+    # adapters can only be folded into unquantised weights, and CPU half precision matmuls are either missing or
+    # lossy, so the merge runs in float32 and the result is cast to the export dtype afterwards
+    dtype = torch.bfloat16 if args.bf16 else torch.float16
+    base_model = AutoModelForCausalLM.from_pretrained(
+        peft_config.base_model_name_or_path,
+        return_dict=True,
+        torch_dtype=torch.float32,
+        device_map={'': 'cpu'},
+        low_cpu_mem_usage=True,
+    )
+
+    tokenizer = AutoTokenizer.from_pretrained(peft_config.base_model_name_or_path)
+    model = PeftModel.from_pretrained(base_model, args.lora_weights)
+
+    # same special token handling as generate_cli.py, done once here so inference never has to resize
+    if tokenizer.bos_token is None:
+        tokenizer.bos_token = DEFAULT_BOS_TOKEN
+    if tokenizer.eos_token is None:
+        tokenizer.eos_token = DEFAULT_EOS_TOKEN
+    if tokenizer.unk_token is None:
+        tokenizer.unk_token = DEFAULT_UNK_TOKEN
+
+    if tokenizer._pad_token is None:
+        smart_tokenizer_and_embedding_resize(
+            special_tokens_dict=dict(pad_token=DEFAULT_PAD_TOKEN),
+            tokenizer=tokenizer,
+            model=model,
+        )
+
+    model = model.merge_and_unload()
+    model = model.to(dtype)
+    model.config.torch_dtype = dtype
+    model.save_pretrained(args.output_dir, safe_serialization=True, max_shard_size=args.max_shard_size)
+    tokenizer.save_pretrained(args.output_dir)
+    print(f'Merged model and tokenizer saved to {args.output_dir}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lora_weights", type=str, required=True, help="Adapter weights to merge into their base model")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to write the merged checkpoint to")
+    parser.add_argument("--bf16", action="store_true", default=False, help="Save in bfloat16 instead of float16")
+    parser.add_argument("--max_shard_size", type=str, default="10GB", help="Maximum size of each safetensors shard")
+    args = parser.parse_args()
+    main(args)
@@ -1,15 +1,22 @@
 import argparse
-import json
+import os
 import sys
+from collections import defaultdict
 import torch
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM, GenerationConfig, BitsAndBytesConfig, AutoTokenizer
 from peft import PeftConfig, PeftModel
 from utils.prompter import Prompter
+from utils.batching import TokenBudgetBatchSampler
+from utils.result_writer import ResumableJSONLWriter, sample_id, read_records, read_completed_ids
+from utils.response_cache import ResponseCache, cache_key
+from utils.screening import INCLUDE_LABEL, EXCLUDE_LABEL, get_label_token_ids, score_include_exclude, \
+    common_prefix_length, encode_prefix, expand_past_key_values, LabelStoppingCriteria, \
+    SentenceStoppingCriteria
 from datasets import load_dataset
 from torch.utils.data import DataLoader
-from transformers import DataCollatorForSeq2Seq
-import re
+from transformers import DataCollatorForSeq2Seq, StoppingCriteriaList
+import time
 
 
 DEFAULT_BOS_TOKEN = '<s>'
@@ -17,6 +24,12 @@ DEFAULT_EOS_TOKEN = '</s>'
 DEFAULT_UNK_TOKEN = '<unk>'
 DEFAULT_PAD_TOKEN = "[PAD]"
 
+# greedy decoding presets for the classification-style tasks, which only need a label or a single sentence
+TASK_PRESETS = {
+    'inc_exc': {'max_new_tokens': 8, 'stop': 'label'},
+    'exc_reason': {'max_new_tokens': 96, 'stop': 'sentence'},
+}
+
 
 def smart_tokenizer_and_embedding_resize(special_tokens_dict, tokenizer, model):
     """Resize tokenizer and embedding.
@@ -37,61 +50,243 @@ def smart_tokenizer_and_embedding_resize(special_tokens_dict, tokenizer, model):
         output_embeddings[-num_new_tokens:] = output_embeddings_avg
 
 
-def batch_generate(args, dataset, device, generation_config, model, prompter, tokenizer):
-    alpaca_pattern = re.compile('.*(### Instruction:\s+(?P<instruction>.+)\s+### Input:\s+(?P<input>.+)\s+### Response:\s+(?P<response>.*))', re.DOTALL)
-    wizard_pattern = re.compile('.*(USER: (?P<instruction>.*)\n{2})(?P<input>.*)(\s{2} ASSISTANT: (?P<response>.*))', re.DOTALL)
+class CachingWriter(object):
+    """
+    Writes records through to the shared response cache as well as the output file, so that later runs with
+    the same model and configuration can skip the samples they have in common with this one.
+    """
+
+    def __init__(self, writer, cache, keys):
+        self.writer = writer
+        self.cache = cache
+        self.keys = keys
+
+    def write(self, record):
+        written = self.writer.write(record)
+        if written:
+            self.cache.put(self.keys[record['id']],
+                           {k: v for k, v in record.items() if k not in ('id', 'instruction', 'input')})
+        return written
+
+
+def add_sample_ids(dataset):
+    # key every sample by a hash of its instruction and input so finished samples can be skipped on restart
+    dataset['train'] = dataset['train'].map(lambda x: {'id': sample_id(x['instruction'], x['input'])})
+    return dataset
+
+
+def skip_completed(dataset, completed, output_file):
+    remaining = [i for i, x in enumerate(dataset['train']['id']) if x not in completed]
+    if len(remaining) < len(dataset['train']):
+        print(f"Skipping {len(dataset['train']) - len(remaining)} samples already in {output_file}")
+        dataset['train'] = dataset['train'].select(remaining)
+    return dataset
+
+
+def response_cache_config(args, generation_config):
+    # everything besides the rendered prompt that changes what is written for a sample
+    if args.score_mode == 'logits':
+        config = {'score_temperature': args.score_temperature, 'include_threshold': args.include_threshold}
+    else:
+        config = generation_config.to_dict()
+        config.pop('transformers_version', None)
+        config.update({'stop_at_label': args.stop_at_label, 'stop_at_sentence': args.stop_at_sentence})
+    return {'score_mode': args.score_mode, 'bits': args.bits, **config}
+
 
+def use_response_cache(args, dataset, prompter, generation_config, cache, writer):
+    model_id = args.merged_model or args.lora_weights
+    config = response_cache_config(args, generation_config)
+    samples = dataset['train']
+    keys = {id: cache_key(model_id, config, prompter.generate_prompt(instruction, input))
+            for id, instruction, input in zip(samples['id'], samples['instruction'], samples['input'])}
+    hits = cache.get_many(set(keys.values()))
+
+    remaining = []
+    for i, (id, instruction, input) in enumerate(zip(samples['id'], samples['instruction'], samples['input'])):
+        hit = hits.get(keys[id])
+        if hit is None:
+            remaining.append(i)
+        else:
+            # written ahead of the samples left to compute, the output file is sorted once the run completes
+            writer.write({'id': id, 'instruction': instruction, 'input': input, **hit})
+
+    if len(remaining) < len(samples):
+        print(f"Copied {len(samples) - len(remaining)} responses from {args.response_cache}")
+        dataset['train'] = samples.select(remaining)
+    return dataset, CachingWriter(writer, cache, keys)
+
+
+def tokenize_dataset(args, dataset, prompter, tokenizer):
     original_columns = dataset['train'].column_names
-    dataset['train'] = dataset['train'].map(
-        lambda x: tokenizer(
-            prompter.generate_prompt(x['instruction'], x['input']),
-            truncation=True,
-            padding=False),
-        remove_columns=original_columns).select(range(args.start_from, len(dataset['train'])))
+    return dataset['train'].map(
+        lambda x, idx: {
+            **tokenizer(
+                prompter.generate_prompt(x['instruction'], x['input']),
+                truncation=True,
+                padding=False),
+            'idx': idx},
+        with_indices=True,
+        remove_columns=original_columns)
+
 
+def make_batch_iter(args, tokenized, tokenizer, extra_tokens=0, copies=1):
     collator = DataCollatorForSeq2Seq(tokenizer, return_tensors="pt", padding=True)
-    batch_iter = DataLoader(dataset['train'], batch_size=args.batch_size, shuffle=False, collate_fn=collator)
+    if args.max_batch_tokens is None:
+        return DataLoader(tokenized, batch_size=args.batch_size, shuffle=False, collate_fn=collator)
+
+    # bucket prompts of similar length so batches are packed up to the token budget instead of padded to an outlier
+    lengths = [(len(input_ids) + extra_tokens) * copies for input_ids in tokenized['input_ids']]
+    sampler = TokenBudgetBatchSampler(lengths, args.max_batch_tokens, max_batch_size=args.batch_size)
+    return DataLoader(tokenized, batch_sampler=sampler, collate_fn=collator)
+
+
+def score_record(args, sample, include_prob):
+    return {
+        'id': sample['id'],
+        'instruction': sample['instruction'],
+        'input': sample['input'],
+        'response': INCLUDE_LABEL if include_prob >= args.include_threshold else EXCLUDE_LABEL,
+        'include_prob': include_prob,
+    }
+
+
+def make_stopping_criteria(args, tokenizer, prompt_len):
+    criteria = []
+    if args.stop_at_label:
+        criteria.append(LabelStoppingCriteria(tokenizer, prompt_len))
+    if args.stop_at_sentence:
+        criteria.append(SentenceStoppingCriteria(tokenizer, prompt_len))
+    return StoppingCriteriaList(criteria)
+
+
+def apply_task_preset(args):
+    preset = TASK_PRESETS[args.task]
+    args.num_beams = 1
+    args.no_sample = True
+    args.max_new_tokens = min(args.max_new_tokens, preset['max_new_tokens'])
+    args.stop_at_label = args.stop_at_label or preset['stop'] == 'label'
+    args.stop_at_sentence = args.stop_at_sentence or preset['stop'] == 'sentence'
+    return args
+
+
+def batch_generate(args, dataset, device, generation_config, model, prompter, tokenizer, writer):
+    tokenized = tokenize_dataset(args, dataset, prompter, tokenizer)
+    # every sample is expanded into num_beams sequences, each growing by up to max_new_tokens
+    batch_iter = make_batch_iter(args, tokenized, tokenizer, extra_tokens=generation_config.max_new_tokens,
+                                 copies=generation_config.num_beams)
+    special_ids = torch.tensor([tokenizer.pad_token_id, tokenizer.eos_token_id], device=device)
 
     for batch in tqdm(batch_iter, total=len(batch_iter)):
         input_ids, attention_mask = batch['input_ids'].to(device), batch['attention_mask'].to(device)
-        output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask, generation_config=generation_config)
-
-        decoded_outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
-        
-        with open(args.output_file, "a+") as f:
-            for output in decoded_outputs:
-                if args.prompt_template == 'alpaca':
-                    f.write(json.dumps(alpaca_pattern.match(output).groupdict()) + '\n')
-                if args.prompt_template == 'wizard13b':
-                    f.write(json.dumps(wizard_pattern.match(output).groupdict()) + '\n')
-        
-def main(args):
-    dataset = load_dataset("json", data_files=args.dataset)
-    prompter = Prompter(args.prompt_template)
+        prompt_len = input_ids.shape[1]
+        stopping_criteria = make_stopping_criteria(args, tokenizer, prompt_len)
 
-    generation_config = GenerationConfig(
-        temperature=args.temperature,
-        do_sample=not args.no_sample,
-        top_p=0.5,
-        top_k=40,
-        num_beams=args.num_beams,
-        max_new_tokens=args.max_new_tokens,
-    )
+        start = time.perf_counter()
+        output_ids = model.generate(input_ids=input_ids, attention_mask=attention_mask, generation_config=generation_config,
+                                    stopping_criteria=stopping_criteria)
+        latency = time.perf_counter() - start
 
-    print(args.lora_weights)
-    peft_config = PeftConfig.from_pretrained(args.lora_weights)
-    print("peft_config: ", peft_config)
+        # only the newly generated tokens need decoding, the prompt is already known
+        response_ids = output_ids[:, prompt_len:]
+        responses = tokenizer.batch_decode(response_ids, skip_special_tokens=True)
+        prompt_tokens = attention_mask.sum(dim=-1).tolist()
+        response_tokens = (~torch.isin(response_ids, special_ids)).sum(dim=-1).tolist()
+
+        for i, idx in enumerate(batch['idx'].tolist()):
+            sample = dataset['train'][idx]
+            record = {
+                'id': sample['id'],
+                'instruction': sample['instruction'],
+                'input': sample['input'],
+                'response': responses[i].strip(),
+                'prompt_tokens': prompt_tokens[i],
+                'response_tokens': response_tokens[i],
+                'latency': latency,
+            }
+            writer.write(record)
+
+
+def batch_score(args, dataset, device, model, prompter, tokenizer, writer):
+    # one forward pass per batch, comparing the next-token logits of the include and exclude labels
+    label_ids = get_label_token_ids(tokenizer)
+
+    tokenized = tokenize_dataset(args, dataset, prompter, tokenizer)
+    batch_iter = make_batch_iter(args, tokenized, tokenizer)
+
+    for batch in tqdm(batch_iter, total=len(batch_iter)):
+        input_ids, attention_mask = batch['input_ids'].to(device), batch['attention_mask'].to(device)
+        include_probs = score_include_exclude(model, input_ids, attention_mask, label_ids,
+                                              temperature=args.score_temperature).tolist()
+
+        for idx, include_prob in zip(batch['idx'].tolist(), include_probs):
+            writer.write(score_record(args, dataset['train'][idx], include_prob))
+
+
+def batch_score_shared_prefix(args, dataset, device, model, prompter, tokenizer, writer):
+    # prompts of the same review and instruction share everything up to the abstract when built with the
+    # criteria-first layout, so the prefix is encoded once per review and its KV cache forked for every abstract
+    label_ids = get_label_token_ids(tokenizer)
+    samples = dataset['train']
+
+    groups = defaultdict(list)
+    dois = samples['doi'] if 'doi' in samples.column_names else [None] * len(samples)
+    for i, (doi, instruction) in enumerate(zip(dois, samples['instruction'])):
+        groups[(doi, instruction)].append(i)
+
+    for indices in tqdm(groups.values(), total=len(groups)):
+        group = samples.select(indices)
+        prompts = [prompter.generate_prompt(x['instruction'], x['input']) for x in group]
+        all_ids = tokenizer(prompts, truncation=True, padding=False)['input_ids']
+
+        # keep at least one token per sample outside the cache so there is a position to score from
+        prefix_len = min(common_prefix_length(all_ids), min(len(ids) for ids in all_ids) - 1)
+        prefix_past = encode_prefix(model, torch.tensor([all_ids[0][:prefix_len]], device=device)) if prefix_len > 0 else None
+
+        for start in range(0, len(indices), args.batch_size):
+            suffixes = [ids[prefix_len:] for ids in all_ids[start:start + args.batch_size]]
+            max_len = max(len(suffix) for suffix in suffixes)
+            input_ids = torch.full((len(suffixes), max_len), tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(suffixes), prefix_len + max_len), dtype=torch.long)
+            attention_mask[:, :prefix_len] = 1
+            for row, suffix in enumerate(suffixes):
+                input_ids[row, :len(suffix)] = torch.tensor(suffix)
+                attention_mask[row, prefix_len:prefix_len + len(suffix)] = 1
+
+            past_key_values = expand_past_key_values(prefix_past, len(suffixes)) if prefix_past is not None else None
+            include_probs = score_include_exclude(model, input_ids.to(device), attention_mask.to(device), label_ids,
+                                                  temperature=args.score_temperature,
+                                                  past_key_values=past_key_values).tolist()
+
+            for offset, include_prob in enumerate(include_probs):
+                writer.write(score_record(args, group[start + offset], include_prob))
+
+
+def get_device(args, rank=None):
+    if torch.cuda.is_available():
+        return torch.device("cuda", 0 if rank is None else rank % torch.cuda.device_count())
+    return torch.device("cpu")
+
+
+def load_model(args, device):
+    if args.merged_model is not None:
+        # checkpoint written by export_merged.py: adapters already folded in and embeddings already resized
+        print(args.merged_model)
+        model_name_or_path = args.merged_model
+    else:
+        print(args.lora_weights)
+        peft_config = PeftConfig.from_pretrained(args.lora_weights)
+        print("peft_config: ", peft_config)
+        model_name_or_path = peft_config.base_model_name_or_path
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(device)
     compute_dtype = (torch.float16 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32))
     base_model = AutoModelForCausalLM.from_pretrained(
-        peft_config.base_model_name_or_path,
+        model_name_or_path,
         return_dict=True,
         load_in_4bit=args.bits == 4,
         load_in_8bit=args.bits == 8,
         torch_dtype=(torch.float32 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32)),
-        device_map={'': 0},
+        device_map={'': device.index if device.type == 'cuda' else 'cpu'},
         quantization_config=BitsAndBytesConfig(
             load_in_4bit=args.bits == 4,
             load_in_8bit=args.bits == 8,
@@ -103,8 +298,11 @@ def main(args):
         ),
     )
 
-    tokenizer = AutoTokenizer.from_pretrained(peft_config.base_model_name_or_path)
-    model = PeftModel.from_pretrained(base_model, args.lora_weights)
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    if args.merged_model is not None:
+        model = base_model
+    else:
+        model = PeftModel.from_pretrained(base_model, args.lora_weights)
     print("finetune model is_loaded_in_8bit: ", model.is_loaded_in_8bit)
     print("finetune model is_loaded_in_4bit: ", model.is_loaded_in_4bit)
     print(model.hf_device_map)
@@ -123,7 +321,8 @@ def main(args):
             model=model,
         )
 
-    if not args.bits == 4 and not args.bits == 8:
+    # half precision kernels are only worth it (and only fully supported) on GPU
+    if not args.bits == 4 and not args.bits == 8 and device.type == 'cuda':
         model.half()
 
     model.eval()
@@ -131,7 +330,123 @@ def main(args):
     if torch.__version__ >= "2" and sys.platform != "win32" and args.compile:
         model = torch.compile(model)
 
-    batch_generate(args, dataset, device, generation_config, model, prompter, tokenizer)
+    return model, tokenizer
+
+
+def shard_output_file(output_file, rank):
+    return f"{output_file}.shard{rank}"
+
+
+def dataset_positions(ids):
+    # first position of every sample id in the dataset file
+    position = {}
+    for i, x in enumerate(ids):
+        position.setdefault(x, i)
+    return position
+
+
+def sort_output_file(output_file, position, fsync_every=100):
+    # records are written as soon as they are done, so a crash loses nothing, and put in dataset order at the end
+    records = sorted(read_records(output_file), key=lambda record: position.get(record['id'], len(position)))
+    sorted_file = f"{output_file}.sorted"
+    if os.path.exists(sorted_file):
+        os.remove(sorted_file)
+    with ResumableJSONLWriter(sorted_file, fsync_every=fsync_every) as writer:
+        for record in records:
+            writer.write(record)
+    os.replace(sorted_file, output_file)
+
+
+def run_model(args, dataset, device, generation_config, prompter, writer):
+    model, tokenizer = load_model(args, device)
+
+    if args.score_mode == 'logits' and args.prefix_cache:
+        batch_score_shared_prefix(args, dataset, device, model, prompter, tokenizer, writer)
+    elif args.score_mode == 'logits':
+        batch_score(args, dataset, device, model, prompter, tokenizer, writer)
+    else:
+        batch_generate(args, dataset, device, generation_config, model, prompter, tokenizer, writer)
+
+
+def main(args, rank=None):
+    dataset = add_sample_ids(load_dataset("json", data_files=args.dataset))
+    position = dataset_positions(dataset['train']['id'])
+    if args.start_from:
+        # a position in the dataset file, so it is applied before completed samples are filtered out
+        dataset['train'] = dataset['train'].select(range(args.start_from, len(dataset['train'])))
+    prompter = Prompter(args.prompt_template)
+    completed = read_completed_ids(args.output_file)
+    output_file = args.output_file
+
+    if rank is not None:
+        # contiguous shards so that each worker's output is one ordered run of the dataset
+        dataset['train'] = dataset['train'].shard(args.num_workers, rank, contiguous=True)
+        output_file = shard_output_file(args.output_file, rank)
+        if args.threads_per_worker is not None:
+            torch.set_num_threads(args.threads_per_worker)
+
+    generation_config = GenerationConfig(
+        temperature=args.temperature,
+        do_sample=not args.no_sample,
+        top_p=0.5,
+        top_k=40,
+        num_beams=args.num_beams,
+        max_new_tokens=args.max_new_tokens,
+    )
+
+    device = get_device(args, rank)
+    print(device)
+
+    with ResumableJSONLWriter(output_file, fsync_every=args.fsync_every) as writer:
+        dataset = skip_completed(dataset, completed | writer.completed, output_file)
+        if args.response_cache is not None and len(dataset['train']) > 0:
+            cache = ResponseCache(args.response_cache, max_size_mb=args.response_cache_mb)
+            dataset, writer = use_response_cache(args, dataset, prompter, generation_config, cache, writer)
+        if len(dataset['train']) > 0:
+            run_model(args, dataset, device, generation_config, prompter, writer)
+        else:
+            print(f'All samples already completed in {output_file}')
+
+    if rank is None:
+        # cache hits and bucketed batches are written out of order; shard outputs are put in order when merged
+        sort_output_file(output_file, position, args.fsync_every)
+
+
+def merge_shards(args):
+    # put the shard outputs back into dataset order and append them to the main output file
+    position = dataset_positions(add_sample_ids(load_dataset("json", data_files=args.dataset))['train']['id'])
+
+    shard_files = [shard_output_file(args.output_file, rank) for rank in range(args.num_workers)]
+    records = [record for shard_file in shard_files for record in read_records(shard_file)]
+    records.sort(key=lambda record: position.get(record['id'], len(position)))
+
+    with ResumableJSONLWriter(args.output_file, fsync_every=args.fsync_every) as writer:
+        for record in records:
+            writer.write(record)
+
+    for shard_file in shard_files:
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+    print(f'Merged {len(records)} records from {args.num_workers} workers into {args.output_file}')
+
+
+def launch_workers(args):
+    # one process per device (or per CPU thread group), each loading the model once and scoring its own shard
+    if not torch.cuda.is_available() and args.threads_per_worker is None:
+        args.threads_per_worker = max(1, (os.cpu_count() or 1) // args.num_workers)
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=main, args=(args, rank)) for rank in range(args.num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed, shard outputs were kept so the run can be resumed")
+
+    merge_shards(args)
 
 
 if __name__ == "__main__":
@@ -141,6 +456,8 @@ if __name__ == "__main__":
     parser.add_argument("--input", type=str, default=None)
     parser.add_argument("--bits", type=int, default=4)
     parser.add_argument("--lora_weights", type=str, default="tloen/alpaca-lora-7b")
+    parser.add_argument("--merged_model", type=str, default=None,
+                        help="Load a merged safetensors checkpoint from export_merged.py instead of base model + --lora_weights")
     parser.add_argument("--prompt_template", type=str, default="alpaca")
     parser.add_argument("--compile", type=bool, default=False)
     parser.add_argument("--max_new_tokens", type=int, default=128)
@@ -151,12 +468,56 @@ if __name__ == "__main__":
     parser.add_argument("--output_file", type=str, default="eval.jsonl")
     parser.add_argument("--num_beams", type=int, default=4)
     parser.add_argument("--start_from", type=int, default=0)
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Shard the dataset across this many worker processes (one per GPU, or CPU processes) "
+                             "and merge their outputs in dataset order")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        help="torch thread limit for each worker (defaults to an even split of the CPUs on CPU-only hosts)")
+    parser.add_argument("--fsync_every", type=int, default=100,
+                        help="Flush and fsync the output file every this many records")
+    parser.add_argument("--response_cache", type=str, default=None,
+                        help="SQLite response cache shared with query_gpt.py and across runs; samples whose model, "
+                             "config and rendered prompt were already answered are copied instead of recomputed")
+    parser.add_argument("--response_cache_mb", type=float, default=1024,
+                        help="Size above which least recently used entries of --response_cache are evicted")
     parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_batch_tokens", type=int, default=None,
+                        help="If set, bucket prompts by token length and pack batches up to this many padded tokens "
+                             "(--batch_size then caps the number of samples per batch)")
     parser.add_argument("--temperature", type=float, default=0.6)
     parser.add_argument("--no_sample", action="store_true", default=False)
+    parser.add_argument("--stop_at_label", action="store_true", default=False,
+                        help="Stop generating once every response in the batch contains an Included/Excluded label "
+                             "(generate mode only, for include/exclude datasets)")
+    parser.add_argument("--stop_at_sentence", action="store_true", default=False,
+                        help="Stop generating once every response in the batch has completed its first sentence")
+    parser.add_argument("--task", type=str, default=None, choices=list(TASK_PRESETS),
+                        help="Greedy decoding preset with task-specific early stopping and max new tokens: "
+                             "inc_exc stops after the label, exc_reason after the first sentence")
+    parser.add_argument("--score_mode", type=str, default="generate", choices=["generate", "logits"],
+                        help="generate: decode full responses. logits: score include/exclude from a single forward pass")
+    parser.add_argument("--score_temperature", type=float, default=1.0,
+                        help="Temperature applied to the include/exclude logits before normalising, fitted with "
+                             "evaluate.py --fit_temperature (logits mode only)")
+    parser.add_argument("--prefix_cache", action="store_true", default=False,
+                        help="Group samples by review (doi) and reuse the KV cache of their shared prompt prefix "
+                             "(logits mode only, use with the criteria-first input layout)")
+    parser.add_argument("--include_threshold", type=float, default=0.5,
+                        help="Include probability at or above which a sample is labelled Included (logits mode only)")
     args = parser.parse_args()
 
+    if args.task is not None:
+        args = apply_task_preset(args)
+
+    if args.prefix_cache and args.score_mode != 'logits':
+        parser.error("--prefix_cache is only supported with --score_mode logits")
+
     if args.output_file == "eval.jsonl":
-        args.output_file = args.lora_weights + "_eval.jsonl"
+        args.output_file = (args.merged_model or args.lora_weights) + "_eval.jsonl"
 
-    main(args)
\ No newline at end of file
+    if args.num_workers > 1:
+        if args.start_from != 0:
+            parser.error("--start_from can't be combined with --num_workers, completed samples are skipped automatically")
+        launch_workers(args)
+    else:
+        main(args)
@@ -1,59 +1,213 @@
 import argparse
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from glob import glob
+from joblib import Parallel, delayed
 from sklearn.model_selection import KFold
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn import metrics
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer, HashingVectorizer
+from sklearn.preprocessing import normalize
 import nltk
 import warnings
 from nltk.corpus import stopwords
-nltk.download('stopwords')
-nltk.download('wordnet')
+from utils.wss import threshold_sweep, wss_at_recall
+
+_nltk_resources = {}
 
 def warn(*args, **kwargs):
     pass
 
+def get_nltk_resources():
+    # built once per process instead of once per abstract, and only when something actually needs preprocessing
+    if not _nltk_resources:
+        _nltk_resources['stop_words'] = set(stopwords.words('english'))
+        _nltk_resources['tokenizer'] = nltk.WordPunctTokenizer()
+        _nltk_resources['lemmatizer'] = nltk.stem.WordNetLemmatizer()
+        _nltk_resources['lemma_cache'] = {}
+    return _nltk_resources
+
+def lemmatize(word):
+    resources = get_nltk_resources()
+    lemma_cache = resources['lemma_cache']
+    if word not in lemma_cache:
+        lemma_cache[word] = resources['lemmatizer'].lemmatize(word)
+    return lemma_cache[word]
+
 def preprocess_text(text, stopword_removal=True, lowercase=True):
+    resources = get_nltk_resources()
     text = text.lower() if lowercase else text
-    stop_words = set(stopwords.words('english'))
-    text = ' '.join([word for word in text.split() if word not in stop_words]) if stopword_removal else text
-    text = nltk.WordPunctTokenizer().tokenize(text)
-    lemm = nltk.stem.WordNetLemmatizer()
-    text = list(map(lambda word: lemm.lemmatize(word), text))
+    text = ' '.join([word for word in text.split() if word not in resources['stop_words']]) if stopword_removal else text
+    text = resources['tokenizer'].tokenize(text)
+    text = list(map(lemmatize, text))
     return text
 
+def identity(x):
+    return x
+
+def review_cache_path(review, cache_dir):
+    # the cache is only valid for the exact review file it was built from, so the file hash is part of its name
+    # and whether a review needs preprocessing can be told without opening the cache
+    with open(review, 'rb') as f:
+        review_hash = hashlib.sha1(f.read()).hexdigest()
+    cache_name = os.path.basename(review).replace('.json', f'.{review_hash[:16]}.preprocessed.json')
+    return os.path.join(cache_dir, cache_name), review_hash
+
+def load_review(review, cache_dir):
+    """
+    Preprocessed abstracts and labels of a review, together with its cache path and hash. They are read from
+    `cache_dir` when the review file is unchanged since the last run so NLTK is skipped entirely.
+    """
+    label_to_idx = {'Included': 1, 'Excluded': 0}
+
+    cache_path, review_hash = review_cache_path(review, cache_dir)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached['review_hash'] == review_hash:
+            return cached['abstracts'], cached['labels'], cache_path, review_hash
+
+    review_df = pd.read_json(review)
+    abstracts = review_df['abstract'].transform(lambda x: preprocess_text(x)).tolist()
+    labels = review_df['label'].transform(lambda x: label_to_idx[x]).tolist()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump({'review_hash': review_hash, 'abstracts': abstracts, 'labels': labels}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return abstracts, labels, cache_path, review_hash
+
+def load_review_features(review, cache_dir, n_features):
+    """
+    Hashed term counts (CSR) and review-level IDF of a review, stored next to the preprocessed abstracts as
+    `.npz`/`.npy` so that every fold and every later run reuses the same matrices.
+    """
+    abstracts, labels, cache_path, review_hash = load_review(review, cache_dir)
+    store_path = cache_path.replace('.preprocessed.json', f'.{n_features}')
+
+    if os.path.exists(store_path + '.features.npz') and os.path.exists(store_path + '.idf.npy'):
+        return sp.load_npz(store_path + '.features.npz').tocsr(), np.load(store_path + '.idf.npy'), labels
+
+    counts = HashingVectorizer(tokenizer=identity, lowercase=False, token_pattern=None, alternate_sign=False,
+                               norm=None, n_features=n_features).transform(abstracts).tocsr()
+    idf = TfidfTransformer().fit(counts).idf_
+    sp.save_npz(store_path + '.features.npz', counts, compressed=False)
+    np.save(store_path + '.idf.npy', idf)
+    return counts, idf, labels
+
+def run_fold(counts, labels, train_index, test_index):
+    warnings.warn = warn
+    labels = np.array(labels)
+
+    # same weighting as fitting a TfidfVectorizer on the training fold: IDF from training rows only, and
+    # terms never seen in training are dropped from the test rows
+    seen_in_train = np.asarray((counts[train_index] > 0).sum(axis=0)).ravel() > 0
+    tfidf = TfidfTransformer().fit(counts[train_index])
+    x_train = tfidf.transform(counts[train_index])
+    x_test = tfidf.transform(counts[test_index] @ sp.diags(seen_in_train.astype(np.float64)))
+
+    model = LogisticRegression(C=10, random_state=0, max_iter=1000).fit(x_train, labels[train_index])
+
+    return list(model.predict(x_test)), list(labels[test_index])
+
+def simulate_active_learning(counts, idf, labels, args):
+    """
+    Screening order of one review under certainty-based active learning: after a random seed set containing
+    both classes, an SGD model trained on everything screened so far ranks the unscreened abstracts and the top
+    `al_batch_size` are screened next. Features are hashed into a fixed space, so the model is warm-started from
+    one round to the next and each round only costs `al_epochs` passes over the labelled pool.
+    """
+    warnings.warn = warn
+    rng = np.random.RandomState(args.seed)
+    # every abstract of the pool is available unlabelled from the start, so the review-level IDF is fair game
+    x = normalize(counts @ sp.diags(idf))
+    y = np.array(labels)
+
+    order = list(rng.permutation(len(y)))
+    screened = order[:args.al_seed_size]
+    # keep screening at random until both classes have been seen
+    while len(set(y[screened])) < 2 and len(screened) < len(y):
+        screened.append(order[len(screened)])
+
+    unscreened = np.ones(len(y), dtype=bool)
+    unscreened[screened] = False
+    model = SGDClassifier(loss='log_loss', alpha=args.al_alpha, random_state=args.seed)
+
+    while unscreened.any():
+        # the whole labelled pool every round, shuffled, so early labels weigh as much as the latest batch
+        for _ in range(args.al_epochs):
+            pool = rng.permutation(screened)
+            model.partial_fit(x[pool], y[pool], classes=[0, 1])
+        candidates = np.flatnonzero(unscreened)
+        scores = model.decision_function(x[candidates])
+        newly_screened = list(candidates[np.argsort(-scores, kind='stable')[:args.al_batch_size]])
+        unscreened[newly_screened] = False
+        screened.extend(newly_screened)
+
+    return screened
+
+def recall_curve(labels, screened):
+    # the active learning screening order as descending scores, so it goes through the same sweep as LLM scores
+    return threshold_sweep(np.array(labels)[screened], np.arange(len(screened), 0, -1))
+
+def active_learning_main(args, reviews, review_data):
+    curves = Parallel(n_jobs=args.n_jobs)(delayed(simulate_active_learning)(counts, idf, labels, args)
+                                          for counts, idf, labels in review_data)
+
+    tables, summary = [], []
+    for review, (_, _, labels), screened in zip(reviews, review_data, curves):
+        curve = recall_curve(labels, screened)
+        wss, _ = wss_at_recall(curve, args.target_recall)
+        del curve['threshold']
+        tables.append(pd.DataFrame({'review': os.path.basename(review), **curve}))
+        summary.append({'review': os.path.basename(review), 'n': len(labels), 'included': int(sum(labels)),
+                        f'wss@{round(args.target_recall * 100)}': wss})
+
+    pd.concat(tables, ignore_index=True).to_csv(f'{args.data_dir}_al_curves.csv', index=False)
+    print(pd.DataFrame(summary).to_string(index=False))
+
 def main(args):
     warnings.warn = warn
     reviews = glob(f'{args.data_dir}/*.json')
-    
+
     if len(reviews) == 0:
         raise ValueError(f'No reviews found in {args.data_dir}')
-    
-    label_to_idx = {'Included': 1, 'Excluded': 0}
+
+    cache_dir = args.cache_dir if args.cache_dir is not None else f'{args.data_dir}_preprocessed'
 
     kf = KFold(n_splits=args.num_folds, shuffle=True, random_state=0)
     y_hat = []
     labels = []
 
-    for review in reviews:
-        review_df = pd.read_json(review)
-        review_df['abstract'] = review_df['abstract'].transform(lambda x: preprocess_text(x))
-        review_df['label'] = review_df['label'].transform(lambda x: label_to_idx[x])
+    if not all(os.path.exists(review_cache_path(review, cache_dir)[0]) for review in reviews):
+        nltk.download('stopwords')
+        nltk.download('wordnet')
 
-        review_y_hat = []
-        review_labels = []
+    with Parallel(n_jobs=args.n_jobs) as parallel:
+        review_data = parallel(delayed(load_review_features)(review, cache_dir, args.n_features) for review in reviews)
+
+        if args.mode == 'active_learning':
+            active_learning_main(args, reviews, review_data)
+            return
 
-        for train_index, test_index in kf.split(review_df):
-            cv = TfidfVectorizer(tokenizer=lambda x: x, lowercase=False)
-            x_train = cv.fit_transform(review_df['abstract'].values[train_index])
-            x_test = cv.transform(review_df['abstract'].values[test_index])
+        # every fold of every review is independent, so they all go into the same pool
+        folds = [(i, train_index, test_index) for i, (counts, _, _) in enumerate(review_data)
+                 for train_index, test_index in kf.split(counts)]
+        fold_results = parallel(delayed(run_fold)(review_data[i][0], review_data[i][2], train_index, test_index)
+                                for i, train_index, test_index in folds)
 
-            model = LogisticRegression(C=10, random_state=0, max_iter=1000).fit(x_train, review_df['label'].values[train_index])
+    for i, review in enumerate(reviews):
+        review_y_hat = []
+        review_labels = []
+        for (fold_review, _, _), (fold_y_hat, fold_labels) in zip(folds, fold_results):
+            if fold_review == i:
+                review_y_hat.extend(fold_y_hat)
+                review_labels.extend(fold_labels)
 
-            review_y_hat.extend(model.predict(x_test))
-            review_labels.extend(review_df['label'].values[test_index])
-    
         with open(f'{review.split(".")[0]}_lr_results.txt', 'w+') as f:
             f.write(metrics.classification_report(review_labels, review_y_hat))
 
@@ -70,5 +224,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, default='eval_review_subset', help='Directory containing split reviews for kfold training (default: eval_review_subset)')
     parser.add_argument('--num_folds', type=int, default=5, help='Number of folds for kfold training (default: 5)')
+    parser.add_argument('--n_jobs', type=int, default=-1, help='Number of processes used across reviews and folds (default: -1, all CPUs)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Where preprocessed abstracts are cached between runs (default: <data_dir>_preprocessed)')
+    parser.add_argument('--mode', type=str, default='kfold', choices=['kfold', 'active_learning'], help='kfold: static cross validation. active_learning: simulate screening with a model retrained on the growing labelled pool (default: kfold)')
+    parser.add_argument('--al_seed_size', type=int, default=10, help='Random abstracts screened before the first model is trained (default: 10)')
+    parser.add_argument('--al_batch_size', type=int, default=10, help='Abstracts screened between model updates (default: 10)')
+    parser.add_argument('--al_epochs', type=int, default=5, help='partial_fit passes over the labelled pool between screened batches (default: 5)')
+    parser.add_argument('--al_alpha', type=float, default=1e-4, help='Regularisation strength of the SGD model (default: 1e-4)')
+    parser.add_argument('--n_features', type=int, default=2 ** 18, help='Size of the hashed feature space of the feature store (default: 2**18)')
+    parser.add_argument('--target_recall', type=float, default=0.95, help='Recall at which WSS is reported (default: 0.95)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the seed set and SGD (default: 0)')
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
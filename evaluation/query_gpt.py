@@ -2,86 +2,183 @@ import pandas as pd
 import openai
 from tqdm import tqdm
 import argparse
+import asyncio
+import hashlib
 import os
+import random
 from openai.error import RateLimitError
 import time
 from utils.prompter import Prompter
+from utils.result_writer import ResumableJSONLWriter, read_records
+from utils.response_cache import ResponseCache, cache_key
 
 prompter = Prompter("gpt")
 global tokens
 tokens = 0
 
-def make_query(row, args):
-    global tokens
 
-    content = prompter.generate_prompt(
+class TokenBucket(object):
+    """
+    Tokens-per-minute budget shared by all concurrent requests. A request reserves an estimate of its tokens
+    before it is sent and the estimate is corrected with `usage.total_tokens` once the response is back.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.available = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, n):
+        n = min(n, self.capacity)
+        # waiters queue on the lock so a large request isn't starved by a stream of small ones
+        async with self.lock:
+            self._refill()
+            while self.available < n:
+                await asyncio.sleep((n - self.available) / self.rate)
+                self._refill()
+            self.available -= n
+
+    def settle(self, reserved, used):
+        self._refill()
+        self.available -= used - reserved
+
+
+def render_prompt(row):
+    return prompter.generate_prompt(
         instruction=row['instruction'],
-        topic=row['topic'], 
+        topic=row['topic'],
         objectives=row['objectives'],
-        selection_criteria=row['selection_criteria'], 
+        selection_criteria=row['selection_criteria'],
         title=row['title'],
         abstract=row['abstract'])
 
-    response = ask_model(content, args)
+def prompt_key(content, args):
+    # the rendered prompt rather than the row, so template changes miss the cache and dataset reshuffles don't
+    return hashlib.sha1(f"{args.model}\x1f{args.max_tokens}\x1f{content}".encode('utf-8')).hexdigest()
+
+def generation_config(args):
+    return {'temperature': 0, 'max_tokens': args.max_tokens, 'n': 1}
+
+def estimate_tokens(content, args):
+    # ~4 characters per token for English text, plus the completion budget
+    return len(content) // 4 + args.max_tokens
+
+async def make_query(content, args, semaphore, bucket):
+    global tokens
+
+    async with semaphore:
+        response = await ask_model(content, args, bucket)
+    if response is None:
+        return None
+
     gpt_response = response['choices'][0]['message']['content']
     tokens += response['usage']['total_tokens']
 
     return gpt_response
 
-def ask_model(content, args):
+async def ask_model(content, args, bucket):
 
     messages = {
         'role': 'assistant',
         'content': content
     }
 
-    response = None
-    attempts = 0
-    while response is None:
-        if attempts > 10:
-            raise Exception("Too many failed attempts.")
-        
+    reserved = estimate_tokens(content, args)
+    for attempt in range(args.max_attempts):
+        await bucket.acquire(reserved)
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            response = await openai.ChatCompletion.acreate(
+                model=args.model,
                 messages=[messages],
-                temperature=0,
-                max_tokens=args.max_tokens,
-                n=1
+                request_timeout=args.request_timeout,
+                **generation_config(args)
             )
-        
-        except RateLimitError as e:
-            print("sleep", e)
-            attempts += 1
-            time.sleep(60)
-        
-        except Exception as e:  # http code 502 (bad gateway)
-            print(e)
-            time.sleep(10)
-            attempts += 1
-
-    return response
+            bucket.settle(reserved, response['usage']['total_tokens'])
+            return response
+
+        except Exception as e:  # rate limits, http code 502 (bad gateway), timeouts
+            # exponential backoff with full jitter, so retries from concurrent requests don't arrive together
+            delay = random.uniform(0, min(args.max_backoff, args.backoff_base * 2 ** attempt))
+            if isinstance(e, RateLimitError):
+                print("sleep", e)
+            else:
+                print(e)
+            await asyncio.sleep(delay)
+
+    print(f"Too many failed attempts, giving up after {args.max_attempts}.")
+    return None
+
+async def query_prompts(prompts, args, cache, shared_cache=None):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    bucket = TokenBucket(args.tokens_per_minute)
+
+    async def query_prompt(key, content):
+        return key, await make_query(content, args, semaphore, bucket)
+
+    tasks = [asyncio.ensure_future(query_prompt(key, content)) for key, content in prompts.items()]
+    with tqdm(total=len(tasks)) as progress:
+        for task in asyncio.as_completed(tasks):
+            key, gpt_response = await task
+            progress.update(1)
+            if gpt_response is None:
+                continue
+            # written as soon as it arrives, so an interrupted run loses at most the requests in flight
+            cache.write({'id': key, 'gpt_response': gpt_response})
+            if shared_cache is not None:
+                shared_cache.put(cache_key(args.model, generation_config(args), prompts[key]), {'gpt_response': gpt_response})
 
 def main(args):
     openai.api_key = os.getenv("OPENAI_API_KEY")
     if not openai.api_key:
         raise Exception("OPENAI_API_KEY environment variable not set.")
-    
+    if args.api_base is not None:
+        openai.api_base = args.api_base
+
     # Load data
     df = pd.read_json(args.data_path, orient='records')
-    
+
     if 'gpt_response' not in df.columns:
         df['gpt_response'] = None
-    
-    tqdm.pandas()
-    gpt_responses = df[df['gpt_response'].isna()].progress_apply(
-        lambda x: make_query(x, args), axis=1)
-    
-    gpt_responses.name = 'gpt_response'
-    df.update(gpt_responses)
+
+    if args.cache_path is None:
+        args.cache_path = os.path.join(os.path.dirname(args.data_path), 'gpt_response_cache.jsonl')
+
+    # the cache is consulted before anything is sent, and identical prompts within the run are only sent once
+    pending = df[df['gpt_response'].isna()]
+    contents = pd.Series([render_prompt(row) for _, row in pending.iterrows()], index=pending.index, dtype=object)
+    keys = contents.apply(lambda content: prompt_key(content, args))
+    cached = {record['id']: record['gpt_response'] for record in read_records(args.cache_path)}
+    prompts = {key: content for key, content in zip(keys, contents) if key not in cached}
+    print(f'{len(pending) - keys.isin(prompts.keys()).sum()} responses found in {args.cache_path}, {len(prompts)} prompts to query.')
+
+    shared_cache = ResponseCache(args.response_cache, max_size_mb=args.response_cache_mb) if args.response_cache else None
+    with ResumableJSONLWriter(args.cache_path, fsync_every=args.fsync_every) as cache:
+        if shared_cache is not None:
+            # responses already paid for by another run, dataset or script are copied over instead of re-queried
+            shared_keys = {key: cache_key(args.model, generation_config(args), content) for key, content in prompts.items()}
+            hits = shared_cache.get_many(shared_keys.values())
+            for key in [key for key, shared_key in shared_keys.items() if shared_key in hits]:
+                cache.write({'id': key, 'gpt_response': hits[shared_keys[key]]['gpt_response']})
+                del prompts[key]
+            print(f'{len(hits)} responses found in {args.response_cache}, {len(prompts)} prompts left to query.')
+
+        asyncio.run(query_prompts(prompts, args, cache, shared_cache))
+
+    if shared_cache is not None:
+        shared_cache.close()
+
+    cached = {record['id']: record['gpt_response'] for record in read_records(args.cache_path)}
+    df.update(pd.Series(keys.map(cached), name='gpt_response', dtype=object))
 
     print(f'{tokens} tokens used.')
-    
+
     print(f'{df["gpt_response"].isna().sum()} failed requests.')
 
     if not args.data_path.endswith('_gpt.json'):
@@ -92,5 +189,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_path', type=str, default='data.json', help='Path to data json file')
     parser.add_argument('--max_tokens', type=int, default=512, help='Max tokens to use for GPT completion')
+    parser.add_argument('--model', type=str, default='gpt-3.5-turbo', help='Chat completion model to query')
+    parser.add_argument('--api_base', type=str, default=None, help='Override the OpenAI API base url, e.g. a local mock endpoint')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of requests in flight')
+    parser.add_argument('--tokens_per_minute', type=int, default=90000, help='Token rate limit of the account, counted from usage.total_tokens')
+    parser.add_argument('--max_attempts', type=int, default=10, help='Attempts per request before it is counted as failed')
+    parser.add_argument('--backoff_base', type=float, default=1.0, help='Initial backoff in seconds, doubled after every failed attempt')
+    parser.add_argument('--max_backoff', type=float, default=60.0, help='Upper bound of the backoff in seconds')
+    parser.add_argument('--request_timeout', type=float, default=120.0, help='Seconds before a request is abandoned and retried')
+    parser.add_argument('--cache_path', type=str, default=None, help='Append-only response cache keyed by prompt hash, shared across runs and templates (default: gpt_response_cache.jsonl next to the data)')
+    parser.add_argument('--response_cache', type=str, default=None, help='SQLite response cache shared with generate_cli.py and across datasets')
+    parser.add_argument('--response_cache_mb', type=float, default=1024, help='Size above which least recently used entries of --response_cache are evicted')
+    parser.add_argument('--fsync_every', type=int, default=1, help='Responses written between fsyncs of the response cache')
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
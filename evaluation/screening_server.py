@@ -0,0 +1,164 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.prompter import Prompter
+from utils.screening import INCLUDE_LABEL, EXCLUDE_LABEL, get_label_token_ids, score_include_exclude
+from generate_cli import get_device, load_model
+
+INC_EXC_INSTRUCTION = "Given the abstract, objectives and selection criteria should the study be included or excluded?"
+INC_EXC_INPUT = "Abstract: {abstract}\n Objectives: {objectives}\n Selection Criteria: {selection_criteria}\n"
+
+
+class DynamicBatcher(object):
+    """
+    Collects screening requests from concurrent clients and scores them together. A batch is closed once it
+    reaches `max_batch_size` or `batch_window` seconds after its first request arrived, whichever comes first.
+    """
+
+    def __init__(self, args, model, tokenizer, prompter, device):
+        self.args = args
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prompter = prompter
+        self.device = device
+        self.label_ids = get_label_token_ids(tokenizer)
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, instruction, input):
+        future = Future()
+        self.requests.put((instruction, input, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.args.batch_window_ms / 1000
+        while len(batch) < self.args.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                prompts = [self.prompter.generate_prompt(instruction, input) for instruction, input, _ in batch]
+                encoded = self.tokenizer(prompts, truncation=True, padding=True, return_tensors="pt")
+                include_probs = score_include_exclude(self.model, encoded['input_ids'].to(self.device),
+                                                      encoded['attention_mask'].to(self.device), self.label_ids,
+                                                      temperature=self.args.score_temperature).tolist()
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, _, future), include_prob in zip(batch, include_probs):
+                future.set_result({
+                    'response': INCLUDE_LABEL if include_prob >= self.args.include_threshold else EXCLUDE_LABEL,
+                    'include_prob': include_prob,
+                })
+
+
+def parse_sample(sample):
+    # either a ready-made `input` or the separate abstract, objectives and selection criteria
+    instruction = sample.get('instruction', INC_EXC_INSTRUCTION)
+    if 'input' in sample:
+        return instruction, sample['input']
+    return instruction, INC_EXC_INPUT.format(abstract=sample['abstract'], objectives=sample['objectives'],
+                                             selection_criteria=sample['selection_criteria'])
+
+
+def make_handler(batcher, timeout):
+    class ScreeningHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/screen':
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                samples = body if isinstance(body, list) else [body]
+                futures = [batcher.submit(*parse_sample(sample)) for sample in samples]
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self._send_json(400, {'error': f'Invalid request: {e}'})
+                return
+
+            try:
+                results = [future.result(timeout=timeout) for future in futures]
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                return
+
+            self._send_json(200, results if isinstance(body, list) else results[0])
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScreeningHandler
+
+
+def main(args):
+    prompter = Prompter(args.prompt_template)
+    device = get_device(args)
+    print(device)
+    model, tokenizer = load_model(args, device)
+
+    batcher = DynamicBatcher(args, model, tokenizer, prompter, device)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, args.request_timeout))
+    print(f'Screening server listening on http://{args.host}:{args.port}/screen')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bits", type=int, default=4)
+    parser.add_argument("--lora_weights", type=str, default="tloen/alpaca-lora-7b")
+    parser.add_argument("--merged_model", type=str, default=None,
+                        help="Load a merged safetensors checkpoint from export_merged.py instead of base model + --lora_weights")
+    parser.add_argument("--prompt_template", type=str, default="alpaca")
+    parser.add_argument("--compile", type=bool, default=False)
+    parser.add_argument("--fp16", type=bool, default=True)
+    parser.add_argument("--bf16", type=bool, default=False)
+    parser.add_argument("--double_quant", type=bool, default=True)
+    parser.add_argument("--quant_type", type=str, default="nf4")  # either fp4 or nf4
+    parser.add_argument("--score_temperature", type=float, default=1.0,
+                        help="Temperature applied to the include/exclude logits before normalising")
+    parser.add_argument("--include_threshold", type=float, default=0.5,
+                        help="Include probability at or above which a sample is labelled Included")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum number of requests scored together")
+    parser.add_argument("--batch_window_ms", type=float, default=20,
+                        help="How long to wait for more requests after the first one of a batch arrives")
+    parser.add_argument("--request_timeout", type=float, default=60, help="Seconds to wait for a result before failing")
+    args = parser.parse_args()
+    main(args)
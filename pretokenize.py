@@ -0,0 +1,75 @@
+import argparse
+import os
+from transformers import AutoTokenizer
+from datasets import load_dataset, load_from_disk
+from qlora import extract_alpaca_dataset, tokenize_source_target, DEFAULT_BOS_TOKEN, DEFAULT_EOS_TOKEN
+from utils.pretokenized import write_pretokenized, dataset_fingerprint
+
+
+def tokenize_examples(examples, tokenizer, args):
+    # identical to DataCollatorForCausalLM, so training on the store sees the same tokens
+    source_ids, target_ids = tokenize_source_target(examples, tokenizer, args.source_max_len, args.target_max_len)
+    return {
+        'source_ids': source_ids,
+        'target_ids': target_ids,
+        'source_length': [len(ids) for ids in source_ids],
+        'target_length': [len(ids) for ids in target_ids],
+    }
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.model_name_or_path,
+        cache_dir=args.cache_dir,
+        padding_side="right",
+        use_fast=False,
+        tokenizer_type='llama' if 'llama' in args.model_name_or_path else None,  # Needed for HF name change
+    )
+    if tokenizer.bos_token is None:
+        tokenizer.bos_token = DEFAULT_BOS_TOKEN
+    if tokenizer.eos_token is None:
+        tokenizer.eos_token = DEFAULT_EOS_TOKEN
+
+    if args.load_from_disk:
+        dataset = load_from_disk(args.dataset)['train']
+    else:
+        dataset = load_dataset("json", data_files=args.dataset)['train']
+    dataset = dataset.map(extract_alpaca_dataset, remove_columns=['instruction'])
+
+    tokenized = dataset.map(
+        lambda x: tokenize_examples(x, tokenizer, args),
+        batched=True,
+        num_proc=args.num_proc,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing",
+    )
+
+    batches = ((batch['source_ids'], batch['target_ids']) for batch in tokenized.iter(batch_size=10000))
+    write_pretokenized(
+        args.output_dir,
+        batches,
+        tokenized['source_length'],
+        tokenized['target_length'],
+        meta={
+            'dataset': os.path.abspath(args.dataset),
+            'dataset_fingerprint': dataset_fingerprint(args.dataset),
+            'model_name_or_path': args.model_name_or_path,
+            'source_max_len': args.source_max_len,
+            'target_max_len': args.target_max_len,
+        },
+    )
+    print(f'Wrote {len(tokenized)} pretokenized examples to {args.output_dir}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, required=True, help="Training json, as passed to qlora.py --dataset")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="Model whose tokenizer is used for training")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to write the token store, then pass it as --pretokenized_dir")
+    parser.add_argument("--source_max_len", type=int, default=1024)
+    parser.add_argument("--target_max_len", type=int, default=256)
+    parser.add_argument("--num_proc", type=int, default=os.cpu_count())
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--load_from_disk", action="store_true", default=False)
+    args = parser.parse_args()
+    main(args)
@@ -5,6 +5,8 @@ from collections import defaultdict
 import copy
 import json
 import os
+import queue
+import shutil
 from os.path import exists, join, isdir
 from dataclasses import dataclass, field
 import sys
@@ -14,10 +16,14 @@ from tqdm import tqdm
 import logging
 import bitsandbytes as bnb
 from peft_friendly_S2S_Trainer import PEFTFriendlySeq2SeqTrainer
+from utils.pretokenized import PretokenizedStore, dataset_fingerprint
+from utils.batching import TokenBudgetBatchSampler, pack_by_length
+from utils.screening import label_logits, get_label_token_ids, score_include_exclude, screening_metrics, \
+    INCLUDE_LABEL
 
 import torch
 import transformers
-from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
 import argparse
 from transformers import (
     AutoTokenizer, 
@@ -28,7 +34,7 @@ from transformers import (
     LlamaTokenizerFast
 
 )
-from datasets import load_dataset, load_from_disk
+from datasets import load_dataset, load_from_disk, Dataset
 import evaluate
 import nltk
 
@@ -41,6 +47,8 @@ from peft import (
     PeftModel
 )
 from peft.tuners.lora import LoraLayer
+from safetensors.torch import save_file, load_file
+from concurrent.futures import ThreadPoolExecutor
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 
 
@@ -113,6 +121,25 @@ class DataArguments:
         default=False,
         metadata={"help": "Whether to test the last checkpoint or the best checkpoint for eval only."}
     )
+    preprocessing_num_workers: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of processes used to compute the token lengths for `group_by_length`."}
+    )
+    debug_collator: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Scan every collated batch for missing input ids and print what is found."}
+    )
+    packing: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Pack several training examples into each `source_max_len + target_max_len` sequence, "
+                          "with attention and position ids reset at every example boundary. Needs a decoder with "
+                          "`_prepare_decoder_attention_mask`, like LLaMA in the pinned transformers 4.30."}
+    )
+    pretokenized_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Token store written by pretokenize.py for `dataset`. Examples are sliced from its "
+                          "memory-mapped tokens instead of being tokenized in every batch."}
+    )
 
 @dataclass
 class TrainingArguments(transformers.Seq2SeqTrainingArguments):
@@ -161,6 +188,29 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
         default=2048,
         metadata={"help": "Maximum source sequence length for mmlu."}
     )
+    screening_eval_dataset: Optional[str] = field(
+        default=None,
+        metadata={"help": "Held-out Instruct Cochrane json. Its include/exclude samples are scored at every evaluation "
+                          "from the label token logits, and include/exclude recall and F1 and WSS are logged."}
+    )
+    screening_label_field: Optional[str] = field(
+        default='output',
+        metadata={"help": "Field of `screening_eval_dataset` whose first word is the gold Included/Excluded label."}
+    )
+    max_screening_samples: Optional[int] = field(
+        default=None,
+        metadata={"help": "If set, only scores the first `max_screening_samples` include/exclude samples."}
+    )
+    screening_target_recall: float = field(
+        default=0.95,
+        metadata={"help": "Recall at which work saved over sampling (WSS) is reported."}
+    )
+    fast_mmlu_eval: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Score MMLU from the last source position's hidden state projected onto the A/B/C/D "
+                          "lm_head rows only, instead of full-vocabulary logits at every position. "
+                          "`mmlu_loss` is not logged in this mode."}
+    )
     full_finetune: bool = field(
         default=False,
         metadata={"help": "Finetune the entire model without adapters."}
@@ -226,6 +276,11 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
     accelerate_method: str = field(default='auto', metadata={"help": 'The accelerate method to use when distributing models across devices.'})
     load_from_disk: bool = field(default=False, metadata={"help": 'Whether to load the dataset from disk or not.'})
     device_map_disabled: bool = field(default=False, metadata={"help": 'Whether to disable the device map or not.'})
+    async_save: bool = field(default=False, metadata={"help": 'Snapshot the adapter weights to pinned CPU memory at every save and write them as '
+                                                               'safetensors on a background thread instead of stalling training.'})
+    max_inflight_saves: int = field(default=2, metadata={"help": 'With `async_save`, how many snapshots may be waiting to be written before a save blocks.'})
+    max_batch_tokens: Optional[int] = field(default=None, metadata={"help": 'If set, training batches are packed by token length up to this many padded tokens, '
+                                                                         'with `per_device_train_batch_size` capping the number of examples per batch.'})
 
 @dataclass
 class GenerationArguments:
@@ -277,7 +332,109 @@ def find_all_linear_names(args, model):
     return list(lora_module_names)
 
 
+class TokenBudgetTrainerMixin(object):
+    """
+    Swaps the fixed-size training batches for `TokenBudgetBatchSampler` batches when `max_batch_tokens` is set,
+    so batches of short examples hold more of them and long ones are not padded to an outlier.
+    """
+    def get_train_dataloader(self):
+        if self.args.max_batch_tokens is None:
+            return super().get_train_dataloader()
+        if self.args.world_size > 1:
+            raise ValueError("max_batch_tokens is not supported with distributed data parallel training.")
+
+        batch_sampler = TokenBudgetBatchSampler(
+            self.train_dataset['length'],
+            self.args.max_batch_tokens,
+            max_batch_size=self.args.per_device_train_batch_size,
+            shuffle=True,
+            seed=self.args.seed,
+        )
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+class TokenBudgetSeq2SeqTrainer(TokenBudgetTrainerMixin, Seq2SeqTrainer):
+    pass
+
+class TokenBudgetPEFTFriendlySeq2SeqTrainer(TokenBudgetTrainerMixin, PEFTFriendlySeq2SeqTrainer):
+    pass
+
+class ScreeningEvalCallback(transformers.TrainerCallback):
+    """
+    Scores the include/exclude samples of `screening_dataset` with a single forward pass per batch, comparing
+    the next-token logits of the Included and Excluded labels, whenever the trainer evaluates. The metrics are
+    logged and added to the eval metrics as `eval_screening_*`, so they can drive `metric_for_best_model`.
+    """
+    def __init__(self, trainer, screening_dataset):
+        self.trainer = trainer
+        self.dataset = screening_dataset
+        self.label_ids = get_label_token_ids(trainer.tokenizer)
+
+    @torch.no_grad()
+    def include_probs(self, args, model):
+        tokenizer = self.trainer.tokenizer
+        include_probs = []
+        for start in tqdm(range(0, len(self.dataset), args.per_device_eval_batch_size), desc="Screening eval"):
+            batch = self.dataset[start:start + args.per_device_eval_batch_size]
+            # the same source formatting and truncation as the training collator, the label is the next token
+            encoded = tokenizer(
+                [f"{tokenizer.bos_token}{example}" for example in batch['input']],
+                max_length=self.trainer.data_collator.source_max_len,
+                truncation=True,
+                add_special_tokens=False,
+                padding=True,
+                return_tensors='pt',
+            )
+            encoded = self.trainer._prepare_inputs(dict(encoded))
+            with self.trainer.compute_loss_context_manager():
+                include_probs.append(score_include_exclude(model, encoded['input_ids'], encoded['attention_mask'],
+                                                           self.label_ids).cpu())
+        return torch.cat(include_probs).numpy()
+
+    def on_evaluate(self, args, state, control, model=None, metrics=None, **kwargs):
+        model = self.trainer.model
+        was_training = model.training
+        model.eval()
+        include_probs = self.include_probs(args, model)
+        if was_training:
+            model.train()
+
+        results = screening_metrics(include_probs, self.dataset['included'], target_recall=args.screening_target_recall)
+        results = {f'eval_screening_{name}': value for name, value in results.items()}
+        if metrics is not None:
+            metrics.update(results)
+        self.trainer.log(results)
+
+def load_screening_dataset(args):
+    dataset = load_dataset("json", data_files=args.screening_eval_dataset)['train']
+    dataset = dataset.filter(lambda x: 'included or excluded' in x['instruction'])
+    if args.max_screening_samples is not None and len(dataset) > args.max_screening_samples:
+        dataset = dataset.select(range(args.max_screening_samples))
+    dataset = dataset.map(lambda x: {
+        'included': x[args.screening_label_field].strip().lower().startswith(INCLUDE_LABEL.lower()),
+    })
+    return dataset.map(extract_alpaca_dataset, remove_columns=['instruction'])
+
 class SavePeftModelCallback(transformers.TrainerCallback):
+    """
+    Saves the adapter weights of every checkpoint. With `async_save`, the LoRA state dict is copied into pinned
+    host buffers and written as safetensors on a background thread, so training only waits for the
+    device-to-host copy. At most `max_inflight_saves` snapshots are held at once, and each is written to a
+    temporary directory that is renamed into place once complete. Writes still pending at the next save are
+    waited for before the Trainer rotates checkpoints, so `save_total_limit` never deletes one mid-write.
+    """
+    def __init__(self, async_save=False, max_inflight_saves=2):
+        self.async_save = async_save
+        self.max_inflight_saves = max_inflight_saves
+        self.executor = None
+        self.free_buffers = None
+        self.pending = []
+
     def save_model(self, args, state, kwargs):
         print('Saving PEFT checkpoint...')
         if state.best_model_checkpoint is not None:
@@ -286,12 +443,81 @@ class SavePeftModelCallback(transformers.TrainerCallback):
             checkpoint_folder = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
 
         peft_model_path = os.path.join(checkpoint_folder, "adapter_model")
-        kwargs["model"].save_pretrained(peft_model_path)
+        if self.async_save:
+            self.save_model_async(kwargs["model"], peft_model_path)
+        else:
+            kwargs["model"].save_pretrained(peft_model_path)
 
         pytorch_model_path = os.path.join(checkpoint_folder, "pytorch_model.bin")
         if os.path.exists(pytorch_model_path):
             os.remove(pytorch_model_path)
 
+    def snapshot(self, state_dict):
+        # one set of host buffers per in-flight save, reused from one checkpoint to the next
+        if self.free_buffers is None:
+            self.free_buffers = queue.Queue()
+            for _ in range(self.max_inflight_saves):
+                self.free_buffers.put({})
+        buffers = self.free_buffers.get()  # blocks while max_inflight_saves snapshots are still being written
+
+        for name, tensor in state_dict.items():
+            if name not in buffers:
+                buffers[name] = torch.empty(tensor.shape, dtype=tensor.dtype, device='cpu',
+                                            pin_memory=torch.cuda.is_available())
+            buffers[name].copy_(tensor.detach(), non_blocking=True)
+        for device in {tensor.device for tensor in state_dict.values() if tensor.is_cuda}:
+            torch.cuda.synchronize(device)
+        return buffers
+
+    def write(self, buffers, peft_config, peft_model_path):
+        try:
+            tmp_path = f"{peft_model_path}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            save_file(buffers, os.path.join(tmp_path, "adapter_model.safetensors"), metadata={"format": "pt"})
+            peft_config.save_pretrained(tmp_path)
+
+            # a directory can't be renamed over a non-empty one, so an earlier save of the same path is moved aside
+            if os.path.exists(peft_model_path):
+                os.replace(peft_model_path, f"{peft_model_path}.old")
+            os.replace(tmp_path, peft_model_path)
+            shutil.rmtree(f"{peft_model_path}.old", ignore_errors=True)
+        finally:
+            self.free_buffers.put(buffers)
+
+    def save_model_async(self, model, peft_model_path):
+        self.raise_failed_saves()
+        if self.executor is None:
+            # a single writer, so checkpoints land on disk in the order they were taken
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        buffers = self.snapshot(get_peft_model_state_dict(model))
+        peft_config = copy.deepcopy(model.peft_config[model.active_adapter])
+        self.pending.append(self.executor.submit(self.write, buffers, peft_config, peft_model_path))
+
+    def raise_failed_saves(self):
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # the Trainer saves and then rotates old checkpoints out under save_total_limit right after this, so
+        # earlier writes must have landed before a checkpoint directory they write into can be deleted
+        if control.should_save:
+            self.wait()
+        return control
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if control.should_save:
+            self.wait()
+        return control
+
     def on_save(self, args, state, control, **kwargs):
         self.save_model(args, state, kwargs)
         return control
@@ -301,8 +527,10 @@ class SavePeftModelCallback(transformers.TrainerCallback):
             with open(fname, 'a'):
                 os.utime(fname, times)
 
-        touch(join(args.output_dir, 'completed'))
+        # the run is only marked complete once the final adapter is on disk
         self.save_model(args, state, kwargs)
+        self.wait()
+        touch(join(args.output_dir, 'completed'))
 
 def get_accelerate_model(args, checkpoint_dir):
     import ast
@@ -409,6 +637,28 @@ def get_accelerate_model(args, checkpoint_dir):
                     module = module.to(torch.bfloat16)
     return model
 
+def enable_packed_attention_mask(model):
+    """
+    Lets the decoder take the (batch, 1, seq_len, seq_len) masks built by `DataCollatorForPacking`. LLaMA in the
+    pinned transformers 4.30 expands a 2D padding mask into its additive causal mask in
+    `_prepare_decoder_attention_mask`, so 4D masks skip that step and are added to the attention scores as they
+    are, while 2D masks (evaluation, MMLU) are handled as before.
+    """
+    base_model = model.get_base_model() if hasattr(model, 'get_base_model') else model
+    decoder = base_model.get_decoder()
+    if not hasattr(decoder, '_prepare_decoder_attention_mask'):
+        raise ValueError(f"--packing needs a decoder that builds its mask in _prepare_decoder_attention_mask, like "
+                         f"LLaMA in transformers 4.30, but {type(decoder).__name__} in transformers "
+                         f"{transformers.__version__} doesn't have one")
+    prepare_mask = decoder._prepare_decoder_attention_mask
+
+    def prepare_packed_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        if attention_mask is not None and attention_mask.dim() == 4:
+            return attention_mask.to(inputs_embeds.dtype)
+        return prepare_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length)
+
+    decoder._prepare_decoder_attention_mask = prepare_packed_mask
+
 def print_trainable_parameters(args, model):
     """
     Prints the number of trainable parameters in the model.
@@ -446,6 +696,26 @@ def smart_tokenizer_and_embedding_resize(
         input_embeddings[-num_new_tokens:] = input_embeddings_avg
         output_embeddings[-num_new_tokens:] = output_embeddings_avg
 
+def tokenize_source_target(examples, tokenizer, source_max_len, target_max_len):
+    # the truncated source and target token ids of a batch, exactly as the training collators build them
+    sources = [f"{tokenizer.bos_token}{example}" for example in examples['input']]
+    targets = [f"{example}{tokenizer.eos_token}" for example in examples['output']]
+    source_ids = tokenizer(sources, max_length=source_max_len, truncation=True, add_special_tokens=False)['input_ids']
+    target_ids = tokenizer(targets, max_length=target_max_len, truncation=True, add_special_tokens=False)['input_ids']
+    return source_ids, target_ids
+
+def add_token_lengths(dataset, tokenizer, args):
+    """
+    Adds the `length` column used to group batches: the source plus target token count after truncation
+    to `source_max_len`/`target_max_len`, computed once over the whole dataset.
+    """
+    def token_lengths(examples):
+        source_ids, target_ids = tokenize_source_target(examples, tokenizer, args.source_max_len, args.target_max_len)
+        return {'length': [len(source) + len(target) for source, target in zip(source_ids, target_ids)]}
+
+    return dataset.map(token_lengths, batched=True, num_proc=args.preprocessing_num_workers,
+                       desc="Computing token lengths")
+
 @dataclass
 class DataCollatorForCausalLM(object):
     tokenizer: transformers.PreTrainedTokenizer
@@ -453,63 +723,203 @@ class DataCollatorForCausalLM(object):
     target_max_len: int
     train_on_source: bool
     predict_with_generate: bool
+    debug: bool = False
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
         assert instances[0] is not None
         # Extract elements
         sources = [f"{self.tokenizer.bos_token}{example['input']}" for example in instances]
         targets = [f"{example['output']}{self.tokenizer.eos_token}" for example in instances]
-        # Tokenize
+        # Tokenize straight into right-padded arrays
         tokenized_sources_with_prompt = self.tokenizer(
             sources,
             max_length=self.source_max_len,
             truncation=True,
             add_special_tokens=False,
+            padding=True,
+            return_tensors='np',
         )
-        tokenized_targets = self.tokenizer(
-            targets,
-            max_length=self.target_max_len,
-            truncation=True,
-            add_special_tokens=False,
-        )
-        # Build the input and labels for causal LM
-        input_ids = []
-        labels = [] 
-        for tokenized_source, tokenized_target in zip(
-            tokenized_sources_with_prompt['input_ids'], 
-            tokenized_targets['input_ids']
-        ):
-            if not self.predict_with_generate:
-                input_ids.append(torch.tensor(tokenized_source + tokenized_target))
-                if not self.train_on_source:
-                    labels.append(
-                        torch.tensor([IGNORE_INDEX for _ in range(len(tokenized_source))] + copy.deepcopy(tokenized_target))
-                    )
-                else:
-                    labels.append(torch.tensor(copy.deepcopy(tokenized_source + tokenized_target)))
-            else:
-                input_ids.append(torch.tensor(tokenized_source))
-        # Apply padding
-        input_ids = pad_sequence(input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id)
-        labels = pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX) if not self.predict_with_generate else None
-        data_dict = {
-            'input_ids': input_ids,
-            'attention_mask': input_ids.ne(self.tokenizer.pad_token_id),
-        }
-        if labels is not None:
-            data_dict['labels'] = labels
+        source_ids = tokenized_sources_with_prompt['input_ids']
+        source_lens = tokenized_sources_with_prompt['attention_mask'].sum(axis=1)
+
+        if self.predict_with_generate:
+            input_ids = torch.from_numpy(source_ids.astype(np.int64, copy=False))
+            data_dict = {
+                'input_ids': input_ids,
+                'attention_mask': input_ids.ne(self.tokenizer.pad_token_id),
+                'labels': targets,
+            }
         else:
-            data_dict['labels'] = targets
+            tokenized_targets = self.tokenizer(
+                targets,
+                max_length=self.target_max_len,
+                truncation=True,
+                add_special_tokens=False,
+                padding=True,
+                return_tensors='np',
+            )
+            target_ids = tokenized_targets['input_ids']
+            target_mask = tokenized_targets['attention_mask'].astype(bool)
+            lengths = source_lens + target_mask.sum(axis=1)
+
+            # Build the input and labels for causal LM in one buffer each: sources at the start of every row,
+            # targets scattered in right after them
+            batch_size, max_len = len(instances), int(lengths.max())
+            input_ids = np.full((batch_size, max_len), self.tokenizer.pad_token_id, dtype=np.int64)
+            input_ids[:, :source_ids.shape[1]] = source_ids
+            rows = np.broadcast_to(np.arange(batch_size)[:, None], target_ids.shape)[target_mask]
+            cols = (source_lens[:, None] + np.arange(target_ids.shape[1]))[target_mask]
+            input_ids[rows, cols] = target_ids[target_mask]
+
+            attention_mask = np.arange(max_len) < lengths[:, None]
+            if self.train_on_source:
+                labels = np.where(attention_mask, input_ids, IGNORE_INDEX)
+            else:
+                labels = np.full((batch_size, max_len), IGNORE_INDEX, dtype=np.int64)
+                labels[rows, cols] = target_ids[target_mask]
+            data_dict = {
+                'input_ids': torch.from_numpy(input_ids),
+                'attention_mask': torch.from_numpy(attention_mask),
+                'labels': torch.from_numpy(labels),
+            }
 
-        examine = [True if input_id is None else "" for input_id in data_dict['input_ids']]
-        examine = examine if any(examine) else None
-        if examine:
-            print(examine)
+        if self.debug:
+            examine = [True if input_id is None else "" for input_id in data_dict['input_ids']]
+            examine = examine if any(examine) else None
+            if examine:
+                print(examine)
         return data_dict
 
     def eval(self, eval_mode: bool):
         self.predict_with_generate = eval_mode
 
+@dataclass
+class DataCollatorForPretokenized(DataCollatorForCausalLM):
+    """
+    Slices examples written by pretokenize.py straight out of the memory-mapped token store. Examples that
+    still carry their text (MMLU, or generation during prediction) go through the tokenizing collator.
+    """
+    store: Optional[PretokenizedStore] = None
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        if self.predict_with_generate or 'pretokenized_index' not in instances[0]:
+            return super().__call__(instances)
+
+        examples = [self.store.example(instance['pretokenized_index']) for instance in instances]
+        max_len = max(len(source) + len(target) for source, target in examples)
+        input_ids = np.full((len(examples), max_len), self.tokenizer.pad_token_id, dtype=np.int64)
+        labels = np.full((len(examples), max_len), IGNORE_INDEX, dtype=np.int64)
+        attention_mask = np.zeros((len(examples), max_len), dtype=bool)
+        for row, (source, target) in enumerate(examples):
+            source_len, example_len = len(source), len(source) + len(target)
+            input_ids[row, :source_len] = source
+            input_ids[row, source_len:example_len] = target
+            label_start = 0 if self.train_on_source else source_len
+            labels[row, label_start:example_len] = input_ids[row, label_start:example_len]
+            attention_mask[row, :example_len] = True
+
+        return {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(attention_mask),
+            'labels': torch.from_numpy(labels),
+        }
+
+class TokenizedExamples(object):
+    # the same `example(i)` interface as PretokenizedStore, over a dataset with `source_ids`/`target_ids` columns
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def example(self, i):
+        row = self.dataset[i]
+        return row['source_ids'], row['target_ids']
+
+@dataclass
+class DataCollatorForPacking(DataCollatorForPretokenized):
+    """
+    Lays out each pack of examples (see `pack_by_length`) back to back in one `pack_len` sequence. Every
+    example only attends to itself through a block-diagonal causal mask, gets position ids starting from 0
+    and, unless `train_on_source`, is only trained on its target. Unpacked examples (evaluation, MMLU) go
+    through the parent collators.
+
+    The mask is 4D and additive (0 where attention is allowed, the dtype minimum elsewhere), in the
+    `mask_dtype` of the model's activations. That is the form LLaMA adds to its attention scores in
+    transformers 4.30, and `enable_packed_attention_mask` passes it to the decoder unchanged.
+    """
+    examples: Optional[object] = None
+    pack_len: int = 0
+    mask_dtype: torch.dtype = torch.float32
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        if self.predict_with_generate or 'pack' not in instances[0]:
+            return super().__call__(instances)
+
+        input_ids = np.full((len(instances), self.pack_len), self.tokenizer.pad_token_id, dtype=np.int64)
+        labels = np.full((len(instances), self.pack_len), IGNORE_INDEX, dtype=np.int64)
+        position_ids = np.zeros((len(instances), self.pack_len), dtype=np.int64)
+        # padding positions each get a segment of their own so that they attend to nothing but themselves
+        segment_ids = np.tile(-1 - np.arange(self.pack_len), (len(instances), 1))
+        for row, instance in enumerate(instances):
+            start = 0
+            for segment, i in enumerate(instance['pack']):
+                source, target = self.examples.example(i)
+                source_len, end = len(source), start + len(source) + len(target)
+                input_ids[row, start:start + source_len] = source
+                input_ids[row, start + source_len:end] = target
+                # the first token of an example is never predicted from the example before it
+                label_start = start + 1 if self.train_on_source else start + source_len
+                labels[row, label_start:end] = input_ids[row, label_start:end]
+                position_ids[row, start:end] = np.arange(end - start)
+                segment_ids[row, start:end] = segment
+                start = end
+
+        segment_ids = torch.from_numpy(segment_ids)
+        causal = torch.ones((self.pack_len, self.pack_len), dtype=torch.bool).tril()
+        allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+        attention_mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+        attention_mask.masked_fill_(~allowed, torch.finfo(self.mask_dtype).min)
+
+        return {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': attention_mask[:, None],
+            'position_ids': torch.from_numpy(position_ids),
+            'labels': torch.from_numpy(labels),
+        }
+
+def add_token_ids(dataset, tokenizer, args):
+    def token_ids(examples):
+        source_ids, target_ids = tokenize_source_target(examples, tokenizer, args.source_max_len, args.target_max_len)
+        return {'source_ids': source_ids, 'target_ids': target_ids,
+                'length': [len(source) + len(target) for source, target in zip(source_ids, target_ids)]}
+
+    return dataset.map(token_ids, batched=True, num_proc=args.preprocessing_num_workers,
+                       remove_columns=dataset.column_names, desc="Tokenizing")
+
+def pack_dataset(train_dataset, tokenizer, args, store=None):
+    """
+    Groups the training examples into packs filling `source_max_len + target_max_len` tokens. Returns the
+    dataset of packs, one row per packed sequence, and the examples the packs index into.
+    """
+    if store is not None:
+        examples = store
+        indices = train_dataset['pretokenized_index']
+        lengths = store.lengths()[indices].tolist()
+    else:
+        examples = TokenizedExamples(add_token_ids(train_dataset, tokenizer, args))
+        indices = list(range(len(examples)))
+        lengths = examples.dataset['length']
+
+    packs = pack_by_length(lengths, args.source_max_len + args.target_max_len)
+    print(f'Packed {len(lengths)} examples into {len(packs)} sequences, '
+          f'{sum(lengths) / (len(packs) * (args.source_max_len + args.target_max_len)):.1%} of tokens used')
+    packed = Dataset.from_dict({
+        'pack': [[indices[i] for i in pack] for pack in packs],
+        'length': [sum(lengths[i] for i in pack) for pack in packs],
+    })
+    return packed, examples
+
 def extract_unnatural_instructions_data(examples, extract_reformulations=False):
     out = {
         'input': [],
@@ -617,6 +1027,18 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
                 dataset = load_dataset("json", data_files=args.dataset)
         dataset = dataset.map(extract_alpaca_dataset, remove_columns=['instruction'])
 
+    store = None
+    if args.pretokenized_dir is not None:
+        store = PretokenizedStore(args.pretokenized_dir)
+        # the content fingerprint catches a dataset edited or replaced in place since the store was built
+        store.check(source_max_len=args.source_max_len, target_max_len=args.target_max_len,
+                    model_name_or_path=args.model_name_or_path, dataset_fingerprint=dataset_fingerprint(args.dataset))
+        if len(store) != len(dataset['train']):
+            raise ValueError(f"{args.pretokenized_dir} holds {len(store)} examples but {args.dataset} has "
+                             f"{len(dataset['train'])}, re-run pretokenize.py")
+        # rows are numbered before any split so that every example can still be found in the store
+        dataset['train'] = dataset['train'].map(lambda x, i: {'pretokenized_index': i}, with_indices=True)
+
     # Split train/eval, reduce size
     if args.do_eval or args.do_predict:
         if args.eval_only_dataset:
@@ -632,21 +1054,54 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
         if args.max_eval_samples is not None and len(eval_dataset) > args.max_eval_samples:
             eval_dataset = eval_dataset.select(range(args.max_eval_samples))
         if args.group_by_length:
-            eval_dataset = eval_dataset.map(lambda x: {'length': len(x['input']) + len(x['output'])})
+            eval_dataset = add_token_lengths(eval_dataset, tokenizer, args)
     if args.do_train:
         train_dataset = dataset['train']
         if args.max_train_samples is not None and len(train_dataset) > args.max_train_samples:
             train_dataset = train_dataset.select(range(args.max_train_samples))
-        if args.group_by_length:
-            train_dataset = train_dataset.map(lambda x: {'length': len(x['input']) + len(x['output'])})
-
-    data_collator = DataCollatorForCausalLM(
-        tokenizer=tokenizer, 
-        source_max_len=args.source_max_len,
-        target_max_len=args.target_max_len,
-        train_on_source=args.train_on_source,
-        predict_with_generate=args.predict_with_generate,
-    )
+        if args.packing:
+            train_dataset, packed_examples = pack_dataset(train_dataset, tokenizer, args, store=store)
+        elif store is not None:
+            # only the index is needed, the text would just be carried through the dataloader
+            train_dataset = train_dataset.remove_columns([c for c in train_dataset.column_names if c != 'pretokenized_index'])
+            if args.group_by_length or args.max_batch_tokens is not None:
+                train_dataset = train_dataset.add_column('length', store.lengths()[train_dataset['pretokenized_index']].tolist())
+        elif args.group_by_length or args.max_batch_tokens is not None:
+            train_dataset = add_token_lengths(train_dataset, tokenizer, args)
+
+    if args.packing and args.do_train:
+        data_collator = DataCollatorForPacking(
+            tokenizer=tokenizer,
+            source_max_len=args.source_max_len,
+            target_max_len=args.target_max_len,
+            train_on_source=args.train_on_source,
+            predict_with_generate=args.predict_with_generate,
+            debug=args.debug_collator,
+            store=store,
+            examples=packed_examples,
+            pack_len=args.source_max_len + args.target_max_len,
+            # activations run in the dtype the non-quantized modules are loaded in by get_accelerate_model
+            mask_dtype=torch.bfloat16 if args.bf16 else torch.float32,
+        )
+    elif store is not None:
+        data_collator = DataCollatorForPretokenized(
+            tokenizer=tokenizer,
+            source_max_len=args.source_max_len,
+            target_max_len=args.target_max_len,
+            train_on_source=args.train_on_source,
+            predict_with_generate=args.predict_with_generate,
+            debug=args.debug_collator,
+            store=store,
+        )
+    else:
+        data_collator = DataCollatorForCausalLM(
+            tokenizer=tokenizer,
+            source_max_len=args.source_max_len,
+            target_max_len=args.target_max_len,
+            train_on_source=args.train_on_source,
+            predict_with_generate=args.predict_with_generate,
+            debug=args.debug_collator,
+        )
     return dict(
         train_dataset=train_dataset if args.do_train else None, 
         eval_dataset=eval_dataset if args.do_eval else None,
@@ -654,6 +1109,29 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
         data_collator=data_collator
     )
 
+@torch.no_grad()
+def predict_multiple_choice(trainer, data_loader, choice_ids):
+    """
+    Predicted and reference choice of every example. The answer is the first target token, so only the hidden
+    state right before it is projected, and only onto the `choice_ids` rows of the lm_head.
+    """
+    preds, refs = [], []
+    for batch in tqdm(data_loader, total=len(data_loader)):
+        batch = trainer._prepare_inputs(batch)
+        labels = batch['labels']
+        choices = torch.tensor(choice_ids, device=labels.device)
+        answer_pos = (labels != IGNORE_INDEX).int().argmax(dim=-1)
+        answers = labels.gather(1, answer_pos[:, None])
+        # positions after the last source token are cut or masked, they can't affect it under causal attention
+        last = answer_pos - 1
+        width = int(last.max()) + 1
+        attention_mask = (torch.arange(width, device=labels.device) <= last[:, None]).long()
+        with trainer.compute_loss_context_manager():
+            logits = label_logits(trainer.model, batch['input_ids'][:, :width], attention_mask, choice_ids)
+        preds.append(logits.argmax(dim=-1))
+        refs.append((answers == choices).int().argmax(dim=-1))
+    return torch.cat(preds).cpu(), torch.cat(refs).cpu()
+
 def get_last_checkpoint(checkpoint_dir, test_last_checkpoint=False):
     if isdir(checkpoint_dir):
         is_completed = exists(join(checkpoint_dir, 'completed'))
@@ -685,6 +1163,8 @@ def train():
 
     model = get_accelerate_model(args, checkpoint_dir)
     training_args.skip_loading_checkpoint_weights=True
+    if args.packing and args.do_train:
+        enable_packed_attention_mask(model)
 
     resume_from_checkpoint = checkpoint_dir
     if resume_from_checkpoint:
@@ -700,6 +1180,8 @@ def train():
             checkpoint_name = os.path.join(
                 checkpoint_path, "adapter_model.bin"
             )  # only LoRA model - LoRA config above has to fit
+            if not os.path.exists(checkpoint_name):
+                checkpoint_name = os.path.join(checkpoint_path, "adapter_model.safetensors")  # written by async_save
             resume_from_checkpoint = (
                 False  # So the trainer won't try loading its state
             )
@@ -707,7 +1189,9 @@ def train():
         # The two files above have a different name depending on how they were saved, but are actually the same.
         if os.path.exists(checkpoint_name):
             print(f"Restarting from {checkpoint_name}")
-            if args.originally_distributed:
+            if checkpoint_name.endswith(".safetensors"):
+                adapters_weights = load_file(checkpoint_name, device='cuda:0' if args.originally_distributed else 'cpu')
+            elif args.originally_distributed:
                 print(f"Loading checkpoint with map_location='cuda:0'")
                 adapters_weights = torch.load(checkpoint_name, map_location='cuda:0')
             else:
@@ -767,14 +1251,14 @@ def train():
 
     if args.with_trainer_checkpoint:
         resume_from_checkpoint = True
-        trainer = PEFTFriendlySeq2SeqTrainer(
+        trainer = TokenBudgetPEFTFriendlySeq2SeqTrainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
             **{k:v for k,v in data_module.items() if k != 'predict_dataset'},
         )
     else:
-        trainer = Seq2SeqTrainer(
+        trainer = TokenBudgetSeq2SeqTrainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
@@ -783,7 +1267,8 @@ def train():
 
     # Callbacks
     if not args.full_finetune:
-        trainer.add_callback(SavePeftModelCallback)
+        trainer.add_callback(SavePeftModelCallback(async_save=args.async_save,
+                                                   max_inflight_saves=args.max_inflight_saves))
     if args.do_mmlu_eval:
         if args.mmlu_dataset == 'mmlu-zs':
             mmlu_dataset = load_dataset("json", data_files={
@@ -815,6 +1300,10 @@ def train():
                 source_max_len = trainer.data_collator.source_max_len
                 trainer.data_collator.source_max_len = args.mmlu_source_max_len
                 trainer.model.eval()
+                if args.fast_mmlu_eval:
+                    self.fast_evaluate(args, data_loader)
+                    trainer.data_collator.source_max_len = source_max_len
+                    return
                 preds, refs = [], []
                 loss_mmlu = 0
                 for batch in tqdm(data_loader, total=len(data_loader)):
@@ -847,8 +1336,25 @@ def train():
                 trainer.log(results)
                 trainer.data_collator.source_max_len = source_max_len
 
+            def fast_evaluate(self, args, data_loader):
+                preds, refs = predict_multiple_choice(trainer, data_loader, abcd_idx)
+                # per-subject accuracy from two bincounts instead of a metric computation per subject
+                subjects = sorted(set(mmlu_dataset['subject']))
+                subject_index = {subject: i for i, subject in enumerate(subjects)}
+                subject_ids = torch.tensor([subject_index[subject] for subject in mmlu_dataset['subject']])
+                correct = torch.bincount(subject_ids, weights=(preds == refs).double(), minlength=len(subjects))
+                subject_scores = correct / torch.bincount(subject_ids, minlength=len(subjects))
+
+                results = {f'mmlu_{args.mmlu_split}_accuracy_{subject}': score
+                           for subject, score in zip(subjects, subject_scores.tolist())}
+                results[f'mmlu_{args.mmlu_split}_accuracy'] = subject_scores.mean().item()
+                trainer.log(results)
+
         trainer.add_callback(MMLUEvalCallback)
 
+    if args.screening_eval_dataset is not None:
+        trainer.add_callback(ScreeningEvalCallback(trainer, load_screening_dataset(args)))
+
     # Verifying the datatypes.
     dtypes = {}
     for _, p in model.named_parameters():
@@ -0,0 +1,84 @@
+"""
+Batch samplers and packing that group samples by token length to cut down on padding.
+"""
+
+import bisect
+import random
+
+
+class TokenBudgetBatchSampler(object):
+    """
+    Sorts samples by token length and packs them into batches whose padded size
+    (longest sample x number of samples) stays within `max_tokens`.
+
+    Yields lists of dataset indices so it can be handed to a DataLoader as `batch_sampler`.
+    Samples longer than `max_tokens` on their own still get a batch of one. With `shuffle`, the order of the
+    batches changes on every pass, unless `set_epoch` is called before each one.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=False, seed=0):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        # longest first, so an out-of-memory batch shows up straight away rather than hours into a run
+        order = sorted(range(len(self.lengths)), key=lambda i: self.lengths[i], reverse=True)
+
+        batches = []
+        batch, batch_max_len = [], 0
+        for idx in order:
+            length = self.lengths[idx]
+            new_max_len = max(batch_max_len, length)
+            batch_full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (batch_full or new_max_len * (len(batch) + 1) > self.max_tokens):
+                batches.append(batch)
+                batch, new_max_len = [], length
+            batch.append(idx)
+            batch_max_len = new_max_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.batches)
+        batches = list(self.batches)
+        random.Random(self.seed + self.epoch).shuffle(batches)
+        # not every training loop calls set_epoch on a batch sampler, so move on to the next order by default
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def pack_by_length(lengths, max_tokens):
+    """
+    Packs samples into as few sequences of at most `max_tokens` tokens as it can, by best-fit decreasing:
+    longest first, each sample goes into the open sequence it fills most tightly. Returns lists of indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    packs = []
+    # (tokens left, pack index) of every pack, kept sorted so the tightest fit is a binary search away
+    remaining = []
+    for idx in order:
+        length = lengths[idx]
+        if length > max_tokens:
+            raise ValueError(f"Sample {idx} has {length} tokens, more than the {max_tokens} of a packed sequence")
+        slot = bisect.bisect_left(remaining, (length, -1))
+        if slot < len(remaining):
+            left, pack = remaining.pop(slot)
+        else:
+            left, pack = max_tokens, len(packs)
+            packs.append([])
+        packs[pack].append(idx)
+        bisect.insort(remaining, (left - length, pack))
+    return packs
@@ -0,0 +1,113 @@
+"""
+Memory-mapped store of pre-tokenised source/target pairs, written once by pretokenize.py and sliced by the
+training collator instead of re-tokenising every batch of every epoch.
+"""
+
+import hashlib
+import json
+import os
+from itertools import chain
+import numpy as np
+
+TOKENS_FILE = 'tokens.npy'
+OFFSETS_FILE = 'offsets.npy'
+SOURCE_LENGTHS_FILE = 'source_lengths.npy'
+META_FILE = 'meta.json'
+
+
+def dataset_fingerprint(path, chunk_size=1 << 20):
+    """
+    sha1 of the training data a store was built from: the json file itself, or every file of a `load_from_disk`
+    directory in path order. None when `path` isn't a local file, e.g. a hub dataset name.
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        return None
+
+    digest = hashlib.sha1()
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode('utf-8'))
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_pretokenized(output_dir, batches, source_lengths, target_lengths, meta):
+    """
+    Writes every example's source tokens followed by its target tokens into one flat int32 array.
+
+    `batches` yields (source_ids, target_ids) lists of token id lists in example order, and `source_lengths`
+    and `target_lengths` give their lengths up front so the token array can be allocated on disk in one go.
+    `meta` (tokenizer, truncation lengths, ...) is saved alongside and checked when the store is opened.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    source_lengths = np.asarray(source_lengths, dtype=np.int32)
+    offsets = np.zeros(len(source_lengths) + 1, dtype=np.int64)
+    np.cumsum(source_lengths.astype(np.int64) + np.asarray(target_lengths, dtype=np.int64), out=offsets[1:])
+
+    # the meta file is written last, so a store interrupted half way is never picked up
+    if os.path.exists(os.path.join(output_dir, META_FILE)):
+        os.remove(os.path.join(output_dir, META_FILE))
+
+    tokens = np.lib.format.open_memmap(os.path.join(output_dir, TOKENS_FILE), mode='w+', dtype=np.int32,
+                                       shape=(int(offsets[-1]),))
+    position = 0
+    for source_ids, target_ids in batches:
+        flat = np.fromiter(chain.from_iterable(chain.from_iterable(zip(source_ids, target_ids))), dtype=np.int32)
+        tokens[position:position + len(flat)] = flat
+        position += len(flat)
+    if position != offsets[-1]:
+        raise ValueError(f'Expected {offsets[-1]} tokens from the lengths given, but {position} were written')
+    tokens.flush()
+    del tokens
+
+    np.save(os.path.join(output_dir, OFFSETS_FILE), offsets)
+    np.save(os.path.join(output_dir, SOURCE_LENGTHS_FILE), source_lengths)
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump({**meta, 'num_examples': len(source_lengths), 'num_tokens': int(offsets[-1])}, f, indent=4)
+
+
+class PretokenizedStore(object):
+    """
+    Read-only view of a store written by `write_pretokenized`. The token array is memory-mapped, so dataloader
+    workers share the page cache instead of each holding a copy, and is re-opened rather than pickled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            raise ValueError(f"{path} is not a complete pretokenized dataset, run pretokenize.py first")
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.tokens = np.load(os.path.join(path, TOKENS_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.source_lengths = np.load(os.path.join(path, SOURCE_LENGTHS_FILE))
+
+    def __len__(self):
+        return len(self.source_lengths)
+
+    def lengths(self):
+        # source + target tokens of every example, after truncation
+        return np.diff(self.offsets)
+
+    def example(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        split = start + self.source_lengths[i]
+        return self.tokens[start:split], self.tokens[split:end]
+
+    def check(self, **expected):
+        for key, value in expected.items():
+            if self.meta.get(key) != value:
+                raise ValueError(f"Pretokenized dataset {self.path} was built with {key}={self.meta.get(key)!r}, "
+                                 f"but {value!r} is being used. Re-run pretokenize.py with the training arguments.")
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
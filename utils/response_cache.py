@@ -0,0 +1,102 @@
+"""
+On-disk content-addressed cache of model responses, shared by the GPT and local model evaluation scripts.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def cache_key(model_id, generation_config, prompt):
+    # a response is only reusable for the exact model, decoding settings and rendered prompt that produced it
+    config = json.dumps(generation_config, sort_keys=True, default=str)
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{model_id}\x1f{config}\x1f{prompt_hash}".encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    SQLite table of JSON responses keyed by `cache_key`, safe to share between concurrent processes.
+
+    Every hit refreshes the entry's access time. Once the stored responses exceed `max_size_mb`, the least
+    recently used entries are evicted down to 90% of the limit. The size is checked every `evict_every` writes.
+    """
+
+    def __init__(self, path, max_size_mb=1024, evict_every=100):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb is not None else None
+        self.evict_every = evict_every
+        self._unchecked = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                          '(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.conn.commit()
+
+    def get_many(self, keys, chunk_size=500):
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            rows = self.conn.execute(f"SELECT key, response FROM responses WHERE key IN ({','.join('?' * len(chunk))})",
+                                     chunk).fetchall()
+            found.update((key, json.loads(response)) for key, response in rows)
+
+        if found:
+            now = time.time()
+            self.conn.executemany('UPDATE responses SET last_access = ? WHERE key = ?', [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(key, payload, len(payload), now) for key, payload in
+                ((key, json.dumps(response)) for key, response in items)]
+        self.conn.executemany('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+        self._unchecked += len(rows)
+        if self._unchecked >= self.evict_every:
+            self.evict()
+
+    def put(self, key, response):
+        self.put_many([(key, response)])
+
+    def evict(self):
+        self._unchecked = 0
+        if self.max_bytes is None:
+            return 0
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+
+        # walk entries from least recently used until enough has been freed
+        to_free = total - int(self.max_bytes * 0.9)
+        evicted, freed = [], 0
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if freed >= to_free:
+                break
+            evicted.append((key,))
+            freed += size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self.conn.commit()
+        return len(evicted)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
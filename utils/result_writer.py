@@ -0,0 +1,103 @@
+"""
+Append-only JSONL writer that makes long generation runs resumable and idempotent.
+"""
+
+import hashlib
+import json
+import os
+
+
+def sample_id(instruction, input):
+    # stable across runs and dataset reorderings, unlike a row index
+    return hashlib.sha1(f"{instruction}\x1f{input}".encode('utf-8')).hexdigest()
+
+
+def read_records(path):
+    # complete records of a JSONL file, stopping at a partial or corrupt trailing line
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                return
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return
+            yield record
+
+
+def read_completed_ids(path, id_key='id'):
+    return {record[id_key] for record in read_records(path) if id_key in record}
+
+
+class ResumableJSONLWriter(object):
+    """
+    Keeps a single buffered handle on `path` and writes one JSON record per line, keyed by `record[id_key]`.
+
+    Ids already present in the file are loaded on open and never written again, so a restarted run can skip
+    them. A trailing partial line left behind by a crash is truncated away. The file is flushed and fsynced
+    every `fsync_every` records and on close.
+    """
+
+    def __init__(self, path, id_key='id', fsync_every=100):
+        self.path = path
+        self.id_key = id_key
+        self.fsync_every = fsync_every
+        self.completed = self._load_completed()
+        self._unsynced = 0
+        self._file = open(path, 'a', encoding='utf-8', buffering=1024 * 1024)
+
+    def _load_completed(self):
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if self.id_key in record:
+                    completed.add(record[self.id_key])
+                valid_bytes += len(line)
+
+        if valid_bytes < os.path.getsize(self.path):
+            print(f'Truncating partial output at byte {valid_bytes} of {self.path}')
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        return completed
+
+    def __contains__(self, record_id):
+        return record_id in self.completed
+
+    def write(self, record):
+        record_id = record[self.id_key]
+        if record_id in self.completed:
+            return False
+        self._file.write(json.dumps(record) + '\n')
+        self.completed.add(record_id)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+        return True
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
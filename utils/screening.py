@@ -0,0 +1,150 @@
+"""
+Helpers for scoring include/exclude screening prompts directly from next-token logits.
+"""
+
+import re
+import numpy as np
+import torch
+from transformers import StoppingCriteria
+from utils.wss import threshold_sweep, wss_at_recall
+
+INCLUDE_LABEL = "Included"
+EXCLUDE_LABEL = "Excluded"
+
+
+def get_label_token_ids(tokenizer, labels=(INCLUDE_LABEL, EXCLUDE_LABEL)):
+    # only the first sub-token of each label is needed for the model to commit to a decision
+    label_ids = [tokenizer(label, add_special_tokens=False)['input_ids'][0] for label in labels]
+    if len(set(label_ids)) != len(label_ids):
+        raise ValueError(f"Labels {labels} share their first token and can't be told apart from a single forward pass")
+    return label_ids
+
+
+def last_token_index(attention_mask):
+    # position of the last attended token of each row, regardless of the padding side
+    positions = torch.arange(attention_mask.shape[-1], device=attention_mask.device)
+    return (attention_mask * positions).argmax(dim=-1)
+
+
+def label_logits(model, input_ids, attention_mask, label_ids, past_key_values=None):
+    """
+    Next-token logits restricted to `label_ids` at the last position of each row.
+
+    Only the final hidden state is projected onto the label rows of the output embeddings, so the full
+    (batch, seq_len, vocab) logits tensor is never materialised. When `past_key_values` is given,
+    `attention_mask` covers the cached prefix followed by `input_ids`.
+    """
+    base_model = model.get_base_model() if hasattr(model, 'get_base_model') else model
+    last = last_token_index(attention_mask[:, -input_ids.shape[1]:])
+    rows = torch.arange(input_ids.shape[0], device=input_ids.device)
+
+    if hasattr(base_model, 'get_decoder') and base_model.get_output_embeddings() is not None:
+        hidden_states = base_model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask,
+                                                 past_key_values=past_key_values, use_cache=False)[0]
+        last_hidden = hidden_states[rows, last]
+        lm_head = base_model.get_output_embeddings()
+        bias = lm_head.bias[label_ids] if getattr(lm_head, 'bias', None) is not None else None
+        weight = lm_head.weight[label_ids]
+        return torch.nn.functional.linear(last_hidden.to(weight.dtype), weight, bias).float()
+
+    logits = model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                   use_cache=False).logits
+    return logits[rows, last][:, label_ids].float()
+
+
+@torch.no_grad()
+def score_include_exclude(model, input_ids, attention_mask, label_ids, temperature=1.0, past_key_values=None):
+    """
+    Returns the probability of the first label (include) against the second (exclude) for each row.
+    `temperature` divides the two-way logits; fit it on a held-out split with evaluate.py --fit_temperature.
+    """
+    logits = label_logits(model, input_ids, attention_mask, label_ids, past_key_values=past_key_values) / temperature
+    return torch.softmax(logits, dim=-1)[:, 0]
+
+
+def screening_metrics(include_probs, included, threshold=0.5, target_recall=0.95):
+    """
+    Include/exclude precision, recall and F1 at `threshold`, plus work saved over sampling at `target_recall`
+    when abstracts are screened in order of decreasing include probability.
+    """
+    include_probs, included = np.asarray(include_probs, dtype=float), np.asarray(included, dtype=bool)
+    metrics = {}
+    for name, gold, predicted in [('include', included, include_probs >= threshold),
+                                  ('exclude', ~included, include_probs < threshold)]:
+        true_positives = (gold & predicted).sum()
+        precision = true_positives / predicted.sum() if predicted.any() else 0.0
+        recall = true_positives / gold.sum() if gold.any() else 0.0
+        metrics[f'{name}_precision'] = float(precision)
+        metrics[f'{name}_recall'] = float(recall)
+        metrics[f'{name}_f1'] = float(2 * precision * recall / (precision + recall)) if precision + recall > 0 else 0.0
+
+    metrics[f'wss_{round(target_recall * 100)}'] = wss_at_recall(threshold_sweep(included, include_probs), target_recall)[0]
+    return metrics
+
+
+def common_prefix_length(sequences):
+    # number of leading tokens shared by every sequence
+    shortest = min(sequences, key=len)
+    for i, token in enumerate(shortest):
+        if any(sequence[i] != token for sequence in sequences):
+            return i
+    return len(shortest)
+
+
+@torch.no_grad()
+def encode_prefix(model, prefix_ids):
+    """
+    Runs a single (1, prefix_len) prompt prefix through the model and returns its KV cache as
+    a tuple of (key, value) pairs, ready to be forked with `expand_past_key_values`.
+    """
+    base_model = model.get_base_model() if hasattr(model, 'get_base_model') else model
+    # the decoder alone is enough to fill the cache and skips projecting the prefix onto the vocabulary
+    encoder = base_model.get_decoder() if hasattr(base_model, 'get_decoder') else model
+    past_key_values = encoder(input_ids=prefix_ids, attention_mask=torch.ones_like(prefix_ids),
+                              use_cache=True).past_key_values
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        past_key_values = past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def expand_past_key_values(past_key_values, batch_size):
+    # broadcast a single cached prefix over the batch without copying it
+    return tuple(
+        tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+class LabelStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation once every sequence in the batch has produced one of `labels` after the prompt,
+    so include/exclude screening doesn't keep decoding past the one word that is evaluated.
+    """
+
+    def __init__(self, tokenizer, prompt_len, labels=(INCLUDE_LABEL, EXCLUDE_LABEL)):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.labels = [label.lower() for label in labels]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = self.tokenizer.batch_decode(input_ids[:, self.prompt_len:], skip_special_tokens=True)
+        return all(any(label in text.lower() for label in self.labels) for text in generated)
+
+
+class SentenceStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation once every sequence in the batch has completed its first sentence after the prompt,
+    e.g. the "Excluded because ..." explanation of the exclusion reasoning task.
+    """
+
+    # the punctuation only ends a sentence once whitespace follows, so "vs." or "2.5" at the end of the decoded
+    # text doesn't stop generation early; a response that ends without it stops at EOS or max_new_tokens instead
+    sentence_end = re.compile(r'\w[.!?]\s')
+
+    def __init__(self, tokenizer, prompt_len):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = self.tokenizer.batch_decode(input_ids[:, self.prompt_len:], skip_special_tokens=True)
+        return all(self.sentence_end.search(text) is not None for text in generated)
@@ -5,6 +5,17 @@ import regex as re
 from argparse import Namespace
 from data_cleaning import remove_repeating_substrings
 
+INC_EXC_PROMPT_TEMPLATE = "Abstract: {}\n Objectives: {}\n Selection Criteria: {}\n"
+# objectives and selection criteria first, so every prompt of a review shares everything up to the abstract
+CRITERIA_FIRST_INC_EXC_PROMPT_TEMPLATE = "Objectives: {}\n Selection Criteria: {}\n Abstract: {}\n"
+
+
+def order_inc_exc_inputs(args, abstract, objectives, selection_criteria):
+    if args.criteria_first:
+        return [objectives, selection_criteria, abstract]
+    return [abstract, objectives, selection_criteria]
+
+
 def pico_separate_look_multiple(args, examples, tokenizer, splitter_id, instruction_template_strs, prompt_templates, target_templates, alpaca_format_len):
     data = []
 
@@ -165,7 +176,7 @@ def include_exclude(args, examples, tokenizer, splitter_id, instruction_template
 
                             objectives = clean_up(example["abstract"]["objectives"], "objectives")
                             selection_criteria = clean_up(example["abstract"]["selection criteria"], "selection criteria")
-                            new_inputs = [abstract, objectives, selection_criteria]
+                            new_inputs = order_inc_exc_inputs(args, abstract, objectives, selection_criteria)
 
                             new_input = get_tokens_splits(args, new_inputs, prompt_template, prompt_template_len,
                                                           splitter_id, tokenizer, alpaca_format_len+instruction_template_len)
@@ -213,7 +224,7 @@ def include_exclude(args, examples, tokenizer, splitter_id, instruction_template
                             objectives = clean_up(example["abstract"]["objectives"], "objectives")
                             selection_criteria = clean_up(example["abstract"]["selection criteria"],
                                                           "selection criteria")
-                            new_inputs = [abstract, objectives, selection_criteria]
+                            new_inputs = order_inc_exc_inputs(args, abstract, objectives, selection_criteria)
 
                             ## ADD REASONING TASK EXAMPLES
                             if reason_next and n_reasons < max_reasons and reasons_count < max_reasons_per_study and 'Exclusion Reason' in reference:
@@ -431,8 +442,7 @@ if __name__ == "__main__":
         'instruction_template': [["Given the abstract, what is the study's Population?", "Given the abstract, what is the study's Intervention?",
                                     "Given the abstract, what is the study's Outcome?", "Given the abstract, what is the study's Outcome?"],
                                  "Given the abstract, objectives and selection criteria should the study be included or excluded?"],
-        'prompt_template': ["Abstract: {}",
-                       "Abstract: {}\n Objectives: {}\n Selection Criteria: {}\n"],
+        'prompt_template': ["Abstract: {}", INC_EXC_PROMPT_TEMPLATE],
         'target_template' : [["Population: {}", "Intervention: {}", "Outcome: {}"],
                        ["Included", "Excluded because {}"]],
         'relevant_data_only': False,
@@ -441,9 +451,13 @@ if __name__ == "__main__":
         'gold': False,
         'inc_exc_only': False,
         'always_reason': False,
-        'doi': None
+        'doi': None,
+        'criteria_first': False,
     })
 
+    if args.criteria_first:
+        args.prompt_template[1] = CRITERIA_FIRST_INC_EXC_PROMPT_TEMPLATE
+
     tokenizer = LlamaTokenizerFast.from_pretrained('elinas/llama-7b-hf-transformers-4.29')
     tokenizer.add_special_tokens({'additional_special_tokens': ['<|insert123|>']})
 
@@ -0,0 +1,45 @@
+"""
+Recall and work saved over sampling (WSS) of a screening ranking, shared by the in-training screening eval, the
+LLM results evaluation and the logistic regression baseline. Only needs numpy, so the evaluation scripts don't
+pull in torch.
+"""
+
+import numpy as np
+
+
+def threshold_sweep(included, include_probs):
+    """
+    Screening metrics at every distinct include probability threshold, from a single descending sort.
+    Screening everything at or above a threshold, `workload_saved` is the fraction of abstracts left unread
+    and `wss` is work saved over sampling at the recall reached. Returns a dict of equally long arrays.
+    """
+    included, include_probs = np.asarray(included, dtype=bool), np.asarray(include_probs, dtype=float)
+    order = np.argsort(-include_probs, kind='stable')
+    include_probs, included = include_probs[order], included[order]
+
+    n = len(included)
+    screened = np.arange(1, n + 1)
+    true_positives = np.cumsum(included)
+    # tied scores share a threshold, so only the last position of each run of equal scores is kept
+    last_of_threshold = np.r_[include_probs[1:] != include_probs[:-1], True]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        recall = true_positives / included.sum()
+    workload_saved = 1 - screened / n
+    return {
+        'threshold': include_probs[last_of_threshold],
+        'screened': screened[last_of_threshold],
+        'recall': recall[last_of_threshold],
+        'precision': (true_positives / screened)[last_of_threshold],
+        'workload_saved': workload_saved[last_of_threshold],
+        'wss': (workload_saved - (1 - recall))[last_of_threshold],
+    }
+
+
+def wss_at_recall(sweep, target_recall):
+    # WSS@R is read off the first (highest) threshold reaching the target recall, nan if none does
+    reached = np.flatnonzero(np.asarray(sweep['recall']) >= target_recall)
+    if len(reached) == 0:
+        return float('nan'), float('nan')
+    best = reached[0]
+    return float(sweep['workload_saved'][best] - (1 - target_recall)), float(sweep['threshold'][best])